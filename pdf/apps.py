@@ -1,7 +1,13 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PdfConfig(AppConfig):
     name = 'pdf'
+
+    def ready(self):
+        if getattr(settings, 'PDF_WARMUP_ON_READY', False):
+            from .warmup import warm_up
+            warm_up(verbose=settings.DEBUG)
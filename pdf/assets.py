@@ -0,0 +1,156 @@
+import os
+import mimetypes
+import threading
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from .cache import LRUCache
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Local assets served to WeasyPrint by url_fetcher()
+#
+# Both the file contents (keyed by path + mtime + size) and the results
+# of finders.find() are cached in the worker process, so that assets repeated
+# across pages and requests (the header logo, fonts, ...) are served from memory.
+#
+# Assets too large for the cache are passed to WeasyPrint as open files
+# (which WeasyPrint reads by itself), instead of being read here. This doesn't
+# lower the peak memory of a render: WeasyPrint reads each file in full, just
+# as url_fetcher() used to.
+#
+# Settings:
+#
+#   PDF_ASSET_CACHE_MAX_BYTES -- max size of cached contents (default: 32 MB; 0 = disabled)
+#   PDF_STATIC_PATH_CACHE_SIZE -- max number of cached finders.find() results (default: 1024)
+#   PDF_ASSET_FILE_MIN_BYTES -- assets of this size or more are passed as open files
+#       (default: None, meaning larger than PDF_ASSET_CACHE_MAX_BYTES)
+
+LOCAL_SCHEMES = (
+    ('assets://', lambda: settings.ASSETS_ROOT),
+    ('static://', None),
+    ('media://', lambda: settings.MEDIA_ROOT),
+    ('file:///media/', lambda: settings.MEDIA_ROOT),
+)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _get_cache(name, **kwargs):
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = LRUCache(**kwargs)
+        return _caches[name]
+
+
+def get_asset_cache():
+    return _get_cache(
+        'contents',
+        max_bytes=getattr(settings, 'PDF_ASSET_CACHE_MAX_BYTES', 32 * 1024 * 1024),
+        sizeof=len,
+    )
+
+
+def get_static_path_cache():
+    return _get_cache(
+        'static_paths',
+        max_size=getattr(settings, 'PDF_STATIC_PATH_CACHE_SIZE', 1024),
+    )
+
+
+def get_asset_cache_stats():
+    """
+    Return the asset cache counters, for example:
+
+        {
+            'contents': {'hits': 299, 'misses': 1, 'evictions': 0, 'items': 1, 'bytes': 4096},
+            'static_paths': {'hits': 299, 'misses': 1, 'evictions': 0, 'items': 1, 'bytes': 0},
+        }
+    """
+    return {
+        'contents': get_asset_cache().stats(),
+        'static_paths': get_static_path_cache().stats(),
+    }
+
+
+def clear_asset_cache():
+    get_asset_cache().clear()
+    get_static_path_cache().clear()
+
+
+def find_static(path):
+    """
+    Cached version of finders.find(path)
+    """
+    cache = get_static_path_cache()
+    filepath = cache.get(path)
+    if filepath is None or not os.path.isfile(filepath):
+        filepath = finders.find(path, all=False)
+        if filepath:
+            cache.set(path, filepath)
+    return filepath
+
+
+def resolve_asset_path(url):
+    """
+    Map an url with a local scheme ("assets://", "static://", "media://"
+    or "file:///media/") to a file path;
+    returns None for any other url
+    """
+    for scheme, get_root in LOCAL_SCHEMES:
+        if url.startswith(scheme):
+            path = url[len(scheme):]
+            if get_root is None:
+                filepath = find_static(path)
+                if not filepath:
+                    raise FileNotFoundError('Static file "%s" not found' % path)
+                return filepath
+            return os.path.join(get_root(), path)
+    return None
+
+
+def read_asset(filepath):
+    """
+    Return the contents of the given file, served from the asset cache
+    unless the file has been modified meanwhile
+    """
+    cache = get_asset_cache()
+    stat = os.stat(filepath)
+    if not cache.max_bytes or stat.st_size > cache.max_bytes:
+        with open(filepath, 'rb') as asset:
+            return asset.read()
+
+    key = (filepath, stat.st_mtime_ns, stat.st_size)
+    contents = cache.get(key)
+    if contents is None:
+        with open(filepath, 'rb') as asset:
+            contents = asset.read()
+        cache.set(key, contents)
+    return contents
+
+
+def fetch_asset(url, filepath):
+    """
+    Return the url_fetcher() result for a local asset: either its contents
+    (from the asset cache), or, for assets too large for the cache, an open
+    file which WeasyPrint reads and closes by itself
+    """
+    result = {
+        # The url as requested (not the file path)
+        'redirected_url': url,
+    }
+    mime_type, encoding = mimetypes.guess_type(filepath)
+    if mime_type:
+        result['mime_type'] = mime_type
+
+    min_bytes = getattr(settings, 'PDF_ASSET_FILE_MIN_BYTES', None)
+    if min_bytes is None:
+        max_bytes = get_asset_cache().max_bytes
+        min_bytes = max_bytes + 1 if max_bytes else None
+    if min_bytes is not None and os.path.getsize(filepath) >= min_bytes:
+        result['file_obj'] = open(filepath, 'rb')
+    else:
+        result['string'] = read_asset(filepath)
+    return result
@@ -0,0 +1,228 @@
+import os
+import time
+import tempfile
+import traceback
+from collections import deque
+from django.conf import settings
+from django.core.files import File
+from django.utils.module_loading import import_string
+from .utils import build_pdf_document
+from .utils import build_pdf_context
+from .utils import get_pdf_styles
+from .utils import load_pdf_templates
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Batch rendering of many documents from the same PdfView
+#
+# Sample usage:
+#
+#     from pdf.batch import render_pdf_batch
+#
+#     results = render_pdf_batch(
+#         'reports.views.StatementView',
+#         ({'customer_id': id} for id in customer_ids),
+#         output_dir='/tmp/statements',
+#     )
+#     failed = [result for result in results if result.error]
+
+
+class BatchResult:
+
+    def __init__(self, index, kwargs):
+        self.index = index
+        self.kwargs = kwargs
+        self.filename = None
+        self.error = None
+        self.traceback = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return '<BatchResult %d %s>' % (self.index, self.error or self.filename)
+
+
+def default_batch_filename(index, view):
+    return '%06d__%s' % (index, view.build_filename(extension="pdf"))
+
+
+class BatchRenderer:
+    """
+    Render a PdfView once for each item of "items" (the keyword arguments
+    for view.get_context_data()), sharing templates and stylesheet among all
+    documents.
+
+    Results are saved either in the local folder "output_dir", or in "storage"
+    (under "upload_to").
+
+    Keyword arguments:
+    view -- a PdfView subclass, or its dotted path
+    output_dir -- local folder for the results
+    storage -- alternatively, a Django storage for the results
+    upload_to -- folder for the results, in the storage
+    filename -- callable(index, view) returning the filename for each document
+    shared_styles -- if True, the stylesheet is rendered once, using the context
+        of the first document; set to False if the styles depend on the context
+    use_pool -- if True, documents are rendered in parallel in the render pool
+        (see pdf.pool); the contexts must be picklable
+    progress -- callable(result, done) invoked after each document
+    """
+
+    def __init__(self, view, output_dir=None, storage=None, upload_to='',
+                 filename=None, shared_styles=True, use_pool=False, progress=None):
+        assert output_dir or storage, 'Either output_dir or storage is required'
+        self.view_class = import_string(view) if isinstance(view, str) else view
+        self.output_dir = output_dir
+        self.storage = storage
+        self.upload_to = upload_to
+        self.filename = filename or default_batch_filename
+        self.shared_styles = shared_styles
+        self.use_pool = use_pool
+        self.progress = progress
+        self.templates = None
+        self.styles = None
+
+    def render(self, items):
+        """
+        Render all documents; returns the list of BatchResult
+        (errors are captured in each result, and never raised)
+        """
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+        view = self.view_class()
+        self.templates = load_pdf_templates(
+            view.body_template_name,
+            view.header_template_name,
+            view.footer_template_name,
+        )
+        self.styles = None
+
+        results = []
+        if self.use_pool:
+            documents = self._render_in_pool(items)
+        else:
+            documents = (self._render_one(index, kwargs) for index, kwargs in enumerate(items))
+        for result in documents:
+            results.append(result)
+            if self.progress is not None:
+                self.progress(result, len(results))
+        return results
+
+    def _prepare(self, kwargs):
+        view = self.view_class()
+        context = view.get_context_data(**kwargs)
+        document_kwargs = view.get_pdf_document_kwargs('', context)
+        if self.shared_styles:
+            if self.styles is None:
+                context = build_pdf_context(
+                    document_kwargs['base_url'],
+                    document_kwargs['debug'],
+                    document_kwargs['title'],
+                    document_kwargs['print_date'],
+                    context,
+                    document_kwargs['format'],
+                )
+                self.styles = get_pdf_styles(context, view.styles_template_name)
+            document_kwargs['styles'] = self.styles
+        return view, document_kwargs
+
+    def _render_one(self, index, kwargs):
+        result = BatchResult(index, kwargs)
+        started = time.perf_counter()
+        try:
+            view, document_kwargs = self._prepare(kwargs)
+            filename = self.filename(index, view)
+            if self.storage is None:
+                result.filename = self._write_local(
+                    filename,
+                    lambda f: build_pdf_document(output=f, templates=self.templates, **document_kwargs)
+                )
+            else:
+                with tempfile.TemporaryFile() as f:
+                    build_pdf_document(output=f, templates=self.templates, **document_kwargs)
+                    f.seek(0)
+                    result.filename = self._save(filename, f)
+        except Exception as e:
+            self._failed(result, e)
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    def _render_in_pool(self, items):
+        from .pool import get_render_pool
+        from .pool import wait_for_result
+        from .pool import _build_pdf_bytes
+
+        max_pending = 2 * (getattr(settings, 'PDF_POOL_SIZE', None) or os.cpu_count() or 1)
+        pending = deque()
+
+        def collect(result, view, pool, async_result, started):
+            try:
+                # The pool is restarted when a document times out (see pdf.pool)
+                content, profile = wait_for_result(pool, async_result, getattr(settings, 'PDF_POOL_TIMEOUT', 300))
+                with tempfile.TemporaryFile() as f:
+                    f.write(content)
+                    f.seek(0)
+                    result.filename = self._save(self.filename(result.index, view), f)
+            except Exception as e:
+                self._failed(result, e)
+            result.elapsed = time.perf_counter() - started
+            return result
+
+        for index, kwargs in enumerate(items):
+            result = BatchResult(index, kwargs)
+            started = time.perf_counter()
+            try:
+                view, document_kwargs = self._prepare(kwargs)
+            except Exception as e:
+                self._failed(result, e)
+                yield result
+                continue
+            pool = get_render_pool()
+            pending.append((result, view, pool, pool.apply_async(_build_pdf_bytes, (document_kwargs, )), started))
+            # Keep a bounded number of documents in flight
+            while len(pending) >= max_pending:
+                yield collect(*pending.popleft())
+        while pending:
+            yield collect(*pending.popleft())
+
+    def _save(self, filename, f):
+        if self.storage is not None:
+            return self.storage.save(os.path.join(self.upload_to, filename), File(f, name=filename))
+        def copy(output):
+            while True:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                output.write(chunk)
+
+        return self._write_local(filename, copy)
+
+    def _write_local(self, filename, write):
+        """
+        Call write(f) on a temporary file in "output_dir", then rename it to
+        "filename"; on failure the temporary file is removed, so that no
+        partial document is left behind. Returns the path of the document
+        """
+        filepath = os.path.join(self.output_dir, filename)
+        fd, temp_path = tempfile.mkstemp(dir=self.output_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, filepath)
+        except:
+            os.remove(temp_path)
+            raise
+        return filepath
+
+    @staticmethod
+    def _failed(result, e):
+        result.error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        result.traceback = traceback.format_exc()
+
+
+def render_pdf_batch(view, items, **kwargs):
+    """
+    Shortcut for BatchRenderer(view, **kwargs).render(items)
+    """
+    return BatchRenderer(view, **kwargs).render(items)
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# A simple, thread-safe LRU cache shared by all requests in the worker process
+
+class LRUCache:
+    """
+    Keep up to "max_size" items (and, optionally, up to "max_bytes" bytes,
+    as measured by "sizeof"), evicting the least recently used items first.
+
+    Usage:
+
+        cache = LRUCache(max_size=32)
+        value = cache.get(key)
+        if value is None:
+            value = build_value()
+            cache.set(key, value)
+    """
+
+    def __init__(self, max_size=None, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Never going to fit
+                return
+            self._items[key] = value
+            self._sizes[key] = size
+            self.bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self._items),
+                'bytes': self.bytes,
+            }
+
+    def _remove(self, key):
+        del self._items[key]
+        self.bytes -= self._sizes.pop(key)
+
+    def _evict(self):
+        while self._items and (
+                (self.max_size is not None and len(self._items) > self.max_size) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            key = next(iter(self._items))
+            self._remove(key)
+            self.evictions += 1
@@ -0,0 +1,210 @@
+import re
+import base64
+import hashlib
+import threading
+import contextlib
+import multiprocessing
+from collections import OrderedDict
+from django.conf import settings
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Charts by reference
+#
+# Instead of embedding charts in the HTML as base64 "data:" URIs (which are
+# encoded in Python, inflate the HTML by a third, and are decoded again by
+# WeasyPrint), charts are stored in a ChartRegistry and referenced by a
+# "charts://<key>" url; url_fetcher() passes the raw bytes to WeasyPrint.
+#
+# Sample usage:
+#
+#     def get_context_data(self, **kwargs):
+#         context = super().get_context_data(**kwargs)
+#         registry = ChartRegistry()
+#         context.update({
+#             CHART_REGISTRY_CONTEXT_NAME: registry,
+#             'plot_url': registry.add_chart(data, chart_type='bar'),
+#         })
+#         return context
+#
+# and, in the template:
+#
+#     <img class="plot" src="{{ plot_url }}">
+#
+# The registry is found in the context by layout_pdf_document(), and made
+# available to url_fetcher() while the document is laid out.
+# Charts with the same contents are stored only once.
+#
+# Charts can also be declared in the templates, with the {% pdf_chart %} tag
+# (see pdf.templatetags.pdf_tags): the tag only records the chart, and
+# returns its url; after the body template has been rendered, all recorded
+# charts are built at once before the document is laid out; optionally,
+# in parallel in the render pool (see pdf.pool).
+#
+# Settings:
+#
+#   PDF_CHARTS_IN_POOL -- build the charts recorded by {% pdf_chart %} in the
+#       render pool (default: False, they are built one after the other);
+#       note that the pool is started by the first document with two or more
+#       charts, so it's better to start it in advance with get_render_pool()
+#       (for example, from a post-fork hook); ignored when already running in
+#       a pool process
+
+CHART_SCHEME = 'charts://'
+CHART_REGISTRY_CONTEXT_NAME = 'chart_registry'
+
+CHART_URL_RE = re.compile(r'charts://([0-9a-f]+)')
+
+_local = threading.local()
+
+
+class ChartRegistry:
+
+    def __init__(self):
+        self.charts = OrderedDict()
+        self.pending = OrderedDict()
+
+    def __len__(self):
+        return len(self.charts) + len(self.pending)
+
+    def add(self, content, mime_type):
+        """
+        Store an image, and return its "charts://" url
+        """
+        key = hashlib.sha1(content).hexdigest()
+        if key not in self.charts:
+            self.charts[key] = (content, mime_type)
+        return CHART_SCHEME + key
+
+    def add_chart(self, data, **kwargs):
+        """
+        Build a chart with build_plot_from_data(data, **kwargs) and store it;
+        returns its "charts://" url
+        """
+        from .plot import build_plot_from_data
+        from .plot import chart_mime_type
+        kwargs['as_base64'] = False
+        image = build_plot_from_data(data, **kwargs)
+        return self.add(image, chart_mime_type(kwargs.get('output_format', 'png')))
+
+    def defer_chart(self, data, **kwargs):
+        """
+        Record a chart, to be built later by render_pending(), and return
+        its "charts://" url; the parameters are those of build_plot_from_data()
+        """
+        from .plot import chart_cache_key
+        kwargs['as_base64'] = False
+        key = chart_cache_key(data, **kwargs).split(':')[-1]
+        if key not in self.charts and key not in self.pending:
+            self.pending[key] = dict(kwargs, data=data)
+        return CHART_SCHEME + key
+
+    def render_pending(self, use_pool=None):
+        """
+        Build all the charts recorded with defer_chart(), in parallel in the
+        render pool when enabled; returns the number of charts built
+        """
+        pending = list(self.pending.items())
+        if not pending:
+            return 0
+        if use_pool is None:
+            use_pool = (
+                getattr(settings, 'PDF_CHARTS_IN_POOL', False) and
+                len(pending) > 1 and
+                # pool processes can't have children
+                not multiprocessing.current_process().daemon
+            )
+        specs = [spec for key, spec in pending]
+        if use_pool:
+            from .pool import get_render_pool
+            from .pool import wait_for_result
+            pool = get_render_pool()
+            images = wait_for_result(
+                pool,
+                pool.map_async(_build_chart, specs),
+                getattr(settings, 'PDF_POOL_TIMEOUT', 300),
+            )
+        else:
+            images = [_build_chart(spec) for spec in specs]
+        for (key, spec), image in zip(pending, images):
+            self._store_pending(key, image)
+        return len(pending)
+
+    def _store_pending(self, key, image):
+        from .plot import chart_mime_type
+        spec = self.pending.pop(key)
+        self.charts[key] = (image, chart_mime_type(spec.get('output_format', 'png')))
+
+    def get(self, url):
+        """
+        Returns (content, mime_type) for the given url (or key), or None
+        """
+        if url.startswith(CHART_SCHEME):
+            url = url[len(CHART_SCHEME):]
+        key = url.rstrip('/')
+        if key in self.pending:
+            # Recorded after render_pending() (for example, in a header template)
+            self._store_pending(key, _build_chart(self.pending[key]))
+        return self.charts.get(key)
+
+    def data_uri(self, url):
+        content, mime_type = self.get(url)
+        return 'data:%s;base64,%s' % (mime_type, base64.b64encode(content).decode())
+
+    def inline(self, html):
+        """
+        Replace "charts://" urls in the HTML with "data:" URIs
+        (for format='html', as browsers can't fetch them)
+        """
+        def replace(match):
+            if self.get(match.group(1)) is None:
+                return match.group(0)
+            return self.data_uri(match.group(1))
+        return CHART_URL_RE.sub(replace, html)
+
+
+def _build_chart(spec):
+    from .plot import build_plot_from_data
+    return build_plot_from_data(**spec)
+
+
+def get_chart_registry(context):
+    """
+    The registry in the context (a dict), which is added when missing
+    """
+    registry = context.get(CHART_REGISTRY_CONTEXT_NAME)
+    if registry is None:
+        registry = ChartRegistry()
+        context[CHART_REGISTRY_CONTEXT_NAME] = registry
+    return registry
+
+
+def current_chart_registry():
+    """
+    The registry of the document being laid out in the current thread, if any
+    """
+    return getattr(_local, 'registry', None)
+
+
+@contextlib.contextmanager
+def using_chart_registry(registry):
+    previous = current_chart_registry()
+    _local.registry = registry
+    try:
+        yield registry
+    finally:
+        _local.registry = previous
+
+
+def fetch_chart(url):
+    """
+    url_fetcher() result for a "charts://" url
+    """
+    registry = current_chart_registry()
+    chart = registry.get(url) if registry is not None else None
+    if chart is None:
+        raise ValueError('Chart "%s" not found' % url)
+    content, mime_type = chart
+    return dict(string=content, mime_type=mime_type)
@@ -0,0 +1,203 @@
+import tempfile
+from django.core.paginator import Paginator
+from .fragments import get_template_variables
+from .profiling import RenderProfile
+from .profiling import CountingWriter
+from .profiling import profiling
+from .profiling import profile_count
+from .utils import build_pdf_context
+from .utils import get_pdf_styles
+from .utils import layout_pdf_document
+from .fonts import release_stylesheets
+from .utils import load_pdf_templates
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Chunked rendering of very long documents
+#
+# build_pdf_document() keeps the box tree of every page in memory until the
+# document is written; for documents with thousands of pages, the body can be
+# split into sections instead: each section is laid out and written on its own
+# (with page counters carried across sections), and the partial PDF files are
+# then merged into the output, so that the memory used for layout is bounded
+# by the largest section.
+#
+# Merging requires pypdf (pip install pypdf).
+#
+# Sample usage:
+#
+#     from pdf.chunked import build_chunked_pdf_document
+#     from pdf.chunked import SectionPaginator
+#
+#     with open(filepath, 'wb') as f:
+#         build_chunked_pdf_document(
+#             SectionPaginator(Movement.objects.order_by('date'), 500, name='movements'),
+#             output=f,
+#             **view.get_pdf_document_kwargs('', context)
+#         )
+#
+# Each section is a dict, added to the context for rendering the body of that
+# section. When header or footer reference "page_total", the sections are
+# iterated twice (the first time, just to count pages): in that case "sections"
+# must be re-iterable (a list, or a SectionPaginator; not a generator),
+# unless "page_total" is supplied.
+
+
+class SectionPaginator:
+    """
+    Split a list or queryset into sections of "per_section" items;
+    each section is a dict with keys <name> (the items) and 'section_number'
+    (1-based). Can be iterated more than once
+    """
+
+    def __init__(self, items, per_section, name='object_list'):
+        self.paginator = Paginator(items, per_section)
+        self.name = name
+
+    def __iter__(self):
+        for number in self.paginator.page_range:
+            yield {
+                self.name: self.paginator.page(number).object_list,
+                'section_number': number,
+            }
+
+
+def uses_page_total(templates):
+    """
+    True if any of the given templates references "page_total"
+    (or when it can't be determined)
+    """
+    for template in templates:
+        if template is None:
+            continue
+        names = get_template_variables(template)
+        if names is None or 'page_total' in names:
+            return True
+    return False
+
+
+def merge_pdf_files(files, output, title=''):
+    """
+    Concatenate the PDF files (open file objects) into the "output" stream
+    """
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        raise Exception('Merging PDF files requires pypdf (pip install pypdf)')
+    writer = PdfWriter()
+    for f in files:
+        f.seek(0)
+        writer.append(f)
+    if title:
+        writer.add_metadata({'/Title': title})
+    writer.write(output)
+
+
+def copy_file(source, output, chunk_size=64 * 1024):
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        output.write(chunk)
+
+
+def build_chunked_pdf_document(
+        sections,
+        base_url, debug, title, print_date, extra_context,
+        styles_template_name, body_template_name, header_template_name, footer_template_name,
+        output,
+        format='pdf',
+        page_total=None,
+        **options
+    ):
+    """
+    Same as build_pdf_document(), but the body is rendered, laid out and written
+    once for each section, and the resulting files are merged into "output".
+
+    Keyword arguments:
+    sections -- an iterable of dicts, each added to "extra_context" to render
+        a section of the body (see SectionPaginator)
+    page_total -- the number of pages of the whole document, if known in advance
+
+    Returns the RenderProfile of the document; the "templates", "styles" and
+    "profile" options are supported as in build_pdf_document()
+    """
+    if options.pop('paged_media', False):
+        raise Exception('Paged media mode is not supported for chunked documents')
+    profile = options.pop('profile', None) or RenderProfile(title)
+    templates = options.pop('templates', None)
+    styles = options.pop('styles', None)
+    extra_context = extra_context or {}
+
+    with profiling(profile):
+
+        # Styles and templates are shared by all sections
+        if styles is None:
+            with profile.phase('styles'):
+                context = build_pdf_context(base_url, debug, title, print_date, dict(extra_context), format)
+                styles = get_pdf_styles(context, styles_template_name)
+        if templates is None:
+            with profile.phase('templates'):
+                templates = load_pdf_templates(body_template_name, header_template_name, footer_template_name)
+
+        def layout(section, **kwargs):
+            return layout_pdf_document(
+                base_url=base_url,
+                debug=debug,
+                title=title,
+                print_date=print_date,
+                extra_context=dict(extra_context, **section),
+                styles_template_name=styles_template_name,
+                body_template_name=body_template_name,
+                header_template_name=header_template_name,
+                footer_template_name=footer_template_name,
+                format=format,
+                styles=styles,
+                **kwargs
+            )
+
+        # First pass, only when required: count pages, without header and footer
+        if page_total is None and uses_page_total([templates['header'], templates['footer']]):
+            if iter(sections) is sections:
+                raise Exception('"sections" must be re-iterable when header or footer use "page_total"')
+            page_total = 0
+            with profile.phase('page_count'), profiling(None):
+                for section in sections:
+                    doc = layout(section, templates=dict(templates, header=None, footer=None))
+                    page_total += len(doc.pages)
+                    release_stylesheets(doc)
+                    del doc
+
+        # Second pass: lay out and write each section
+        files = []
+        page_offset = 0
+        try:
+            for section in sections:
+                doc = layout(section, templates=templates, page_offset=page_offset, page_total=page_total)
+                page_offset += len(doc.pages)
+                f = tempfile.TemporaryFile()
+                files.append(f)
+                try:
+                    with profile.phase('write'):
+                        doc.write_pdf(f)
+                finally:
+                    release_stylesheets(doc)
+                del doc
+                profile_count('chunks')
+
+            with profile.phase('merge'):
+                # pypdf calls tell() for each object, which is slow on some
+                # outputs (HttpResponse joins its contents each time);
+                # merge into a temporary file, then copy it
+                with tempfile.TemporaryFile() as merged:
+                    merge_pdf_files(files, merged, title)
+                    merged.seek(0)
+                    copy_file(merged, CountingWriter(output, profile))
+        finally:
+            for f in files:
+                f.close()
+
+    profile.finish()
+    return profile
@@ -0,0 +1,82 @@
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Helpers for async views
+#
+# Settings:
+#
+#   PDF_ASYNC_MAX_CONCURRENT_RENDERS -- max number of documents rendered at the same time
+#       by async views, in each worker process (default: 4)
+
+_executor = None
+_executor_lock = threading.Lock()
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_max_concurrent_renders():
+    return getattr(settings, 'PDF_ASYNC_MAX_CONCURRENT_RENDERS', 4)
+
+
+def get_render_executor():
+    """
+    A dedicated thread pool for renders, so that they don't starve the
+    sync_to_async() thread pool used by the rest of the site
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_max_concurrent_renders(),
+                thread_name_prefix='pdf-render',
+            )
+    return _executor
+
+
+def get_render_semaphore():
+    """
+    The semaphore limiting concurrent renders (one for each event loop)
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(get_max_concurrent_renders())
+        _semaphores[loop] = semaphore
+    return semaphore
+
+
+def _run_and_close_connections(func, *args, **kwargs):
+    from django.db import connections
+    try:
+        return func(*args, **kwargs)
+    finally:
+        connections.close_all()
+
+
+async def run_render(func, *args, **kwargs):
+    """
+    Run the (synchronous) rendering function "func" in the render executor,
+    waiting for a free slot first.
+
+    When cancelled (for example: because the client disconnected), a render
+    not yet started is dropped; a render already in progress can't be
+    interrupted, and its result is discarded.
+    """
+    loop = asyncio.get_running_loop()
+    async with get_render_semaphore():
+        future = loop.run_in_executor(
+            get_render_executor(),
+            functools.partial(_run_and_close_connections, func, *args, **kwargs)
+        )
+        try:
+            return await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
@@ -0,0 +1,143 @@
+import threading
+import contextlib
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Shared font configuration
+#
+# Unless a FontConfiguration is supplied, WeasyPrint creates a new one for each
+# layout (the body, plus the header and footer fragments), and fetches every
+# @font-face again, writing it to a temporary file and registering it with
+# fontconfig.
+#
+# Instead, a FontConfiguration is kept with each parsed stylesheet (see
+# pdf.utils.get_stylesheet_pool()), so it's invalidated when the styles change,
+# and shared by all layouts using them; moreover, @font-face rules already
+# registered (for example, by the <style> element of the previous document)
+# are not loaded again.
+#
+# FontConfiguration is not thread-safe, so the process-wide cache keeps a small
+# pool of parsed copies of each stylesheet (a StylesheetPool), each with its
+# own FontConfiguration: a document checks out one copy when laid out, uses it
+# for the body and all fragments, and checks it in after being written (which,
+# with PdfView.stream_response, happens in another thread); concurrent
+# documents using the same styles get different copies.
+#
+# Settings:
+#
+#   PDF_SHARE_FONT_CONFIG -- share font configurations (default: True)
+#   PDF_STYLESHEET_POOL_SIZE -- idle copies kept for each stylesheet (default: 4)
+
+_local = threading.local()
+
+_font_configuration_class = None
+_font_configuration_class_lock = threading.Lock()
+
+
+def get_font_configuration_class():
+    global _font_configuration_class
+    with _font_configuration_class_lock:
+        if _font_configuration_class is None:
+            try:
+                from weasyprint.text.fonts import FontConfiguration
+            except ImportError:
+                # WeasyPrint < 53
+                from weasyprint.fonts import FontConfiguration
+
+            class SharedFontConfiguration(FontConfiguration):
+                """
+                A FontConfiguration which loads each @font-face only once
+                """
+
+                def __init__(self, *args, **kwargs):
+                    super().__init__(*args, **kwargs)
+                    self.font_faces = {}
+
+                def add_font_face(self, rule_descriptors, url_fetcher):
+                    key = repr(sorted(rule_descriptors.items()))
+                    if key not in self.font_faces:
+                        self.font_faces[key] = super().add_font_face(rule_descriptors, url_fetcher)
+                    return self.font_faces[key]
+
+            _font_configuration_class = SharedFontConfiguration
+    return _font_configuration_class
+
+
+def new_font_config():
+    return get_font_configuration_class()()
+
+
+class StylesheetPool:
+    """
+    Parsed copies of a stylesheet, as (stylesheet, font_config) pairs built by
+    "parse"; when "exclusive", a copy is used by one document at a time,
+    otherwise (no FontConfiguration) a single copy is shared by all documents
+    """
+
+    def __init__(self, parse, max_idle=4, exclusive=True):
+        self.parse = parse
+        self.max_idle = max_idle if exclusive else 1
+        self.exclusive = exclusive
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def check_out(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop() if self.exclusive else self.idle[-1]
+        return self.parse()
+
+    def check_in(self, item):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(item)
+
+
+class StylesheetLeases:
+    """
+    The stylesheet copies checked out by a document, one for each stylesheet
+    text; they are checked in together by release()
+    """
+
+    def __init__(self):
+        self.leases = {}
+
+    def check_out(self, styles, get_pool):
+        if styles not in self.leases:
+            pool = get_pool(styles)
+            self.leases[styles] = (pool, pool.check_out())
+        return self.leases[styles][1]
+
+    def release(self):
+        leases, self.leases = self.leases, {}
+        for pool, item in leases.values():
+            pool.check_in(item)
+
+
+def current_stylesheet_leases():
+    """
+    The leases of the document being laid out in the current thread, if any
+    """
+    return getattr(_local, 'leases', None)
+
+
+@contextlib.contextmanager
+def using_stylesheet_leases(leases):
+    previous = current_stylesheet_leases()
+    _local.leases = leases
+    try:
+        yield leases
+    finally:
+        _local.leases = previous
+
+
+def release_stylesheets(doc):
+    """
+    Check in the stylesheet copies used by a document returned by
+    layout_pdf_document(), once it has been written
+    """
+    leases = getattr(doc, 'stylesheet_leases', None)
+    if leases is not None:
+        leases.release()
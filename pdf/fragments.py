@@ -0,0 +1,293 @@
+import re
+import threading
+import weakref
+from .profiling import profile_count
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Template analysis
+
+# Context variables which change from page to page
+PAGE_VARIABLES = ('page_counter', 'page_total', )
+
+_template_variables = weakref.WeakKeyDictionary()
+
+
+def get_template_variables(template):
+    """
+    Inspect the node tree of a Django template and return the set of names
+    of the context variables it references (followed through {% extends %}
+    and {% include %});
+    returns None when this can't be determined (a non-Django template backend,
+    a dynamic include, a custom tag which might read the context directly, ...)
+    """
+    template = getattr(template, 'template', template)
+    if not hasattr(template, 'nodelist'):
+        return None
+    try:
+        return _template_variables[template]
+    except KeyError:
+        pass
+    try:
+        names = set()
+        _collect_nodelist_variables(template.nodelist, template, names)
+    except _UnknownNode:
+        names = None
+    _template_variables[template] = names
+    return names
+
+
+def is_page_invariant(template):
+    """
+    True if rendering the template doesn't depend on the page being built
+    """
+    names = get_template_variables(template)
+    if names is None:
+        return False
+    return not names.intersection(PAGE_VARIABLES)
+
+
+# Modules of the nodes whose context usage is fully described by their attributes;
+# any other node (custom tags, including simple_tag and inclusion_tag from
+# django.template.library) might read the context directly
+KNOWN_NODE_MODULES = (
+    'django.template.base',
+    'django.template.defaulttags',
+    'django.template.loader_tags',
+    'django.templatetags.i18n',
+    'django.templatetags.static',
+    'django.templatetags.l10n',
+    'django.templatetags.tz',
+    'django.templatetags.cache',
+)
+
+
+class _UnknownNode(Exception):
+    pass
+
+
+def _collect_nodelist_variables(nodelist, template, names):
+    from django.template.loader_tags import ExtendsNode
+    from django.template.loader_tags import IncludeNode
+    from django.template.defaulttags import DebugNode
+
+    for node in nodelist:
+        if (isinstance(node, DebugNode) or
+                getattr(node, 'takes_context', False) or
+                type(node).__module__ not in KNOWN_NODE_MODULES):
+            raise _UnknownNode()
+
+        if isinstance(node, (ExtendsNode, IncludeNode)):
+            expression = node.parent_name if isinstance(node, ExtendsNode) else node.template
+            template_name = expression.var if isinstance(getattr(expression, 'var', None), str) else None
+            if not template_name:
+                raise _UnknownNode()
+            included = template.engine.get_template(template_name)
+            _collect_nodelist_variables(included.nodelist, included, names)
+
+        _collect_variables(vars(node), names)
+        for attr in node.child_nodelists:
+            _collect_nodelist_variables(getattr(node, attr, None) or [], template, names)
+
+
+def _collect_variables(value, names):
+    from django.template.base import FilterExpression
+    from django.template.base import Variable
+    from django.template.base import Node
+    from django.template.base import NodeList
+    from django.template.base import Token
+    from django.template.base import TokenType
+
+    if isinstance(value, FilterExpression):
+        _collect_variables(value.var, names)
+        for func, args in value.filters:
+            for lookup, arg in args:
+                _collect_variables(arg, names)
+    elif isinstance(value, Variable):
+        if value.lookups:
+            names.add(value.lookups[0])
+    elif isinstance(value, Token):
+        # {% blocktranslate %} keeps the raw tokens of its content
+        if value.token_type == TokenType.VAR:
+            names.add(value.contents.split('|')[0].split('.')[0].strip())
+    elif isinstance(value, (Node, NodeList, )):
+        # Already visited via child_nodelists
+        pass
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_variables(item, names)
+    elif isinstance(value, (list, tuple, )):
+        for item in value:
+            _collect_variables(item, names)
+    elif hasattr(value, 'first') or hasattr(value, 'value'):
+        # {% if %} conditions: a tree of operators and literals
+        for attr in ('first', 'second', 'value', ):
+            _collect_variables(getattr(value, attr, None), names)
+
+
+################################################################################
+# Fragment cache statistics
+
+_stats_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+}
+
+
+def _count(hits=0, misses=0):
+    with _stats_lock:
+        _stats['hits'] += hits
+        _stats['misses'] += misses
+
+
+def get_fragment_cache_stats():
+    """
+    Return a dict with the process-wide fragment counters:
+
+        hits -- pages served with an already laid out fragment
+        misses -- fragment variants which required a WeasyPrint layout
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_fragment_cache_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+################################################################################
+# Page fragments (header and footer)
+
+BODY_RE = re.compile(r'(<body[^>]*>)(.*)(</body>)', re.IGNORECASE | re.DOTALL)
+
+# Inserted between the variants of a fragment when laying them out together,
+# so that each variant lands on a page of its own
+PAGE_BREAK = '<div style="page-break-before: always; height: 0; margin: 0; padding: 0;"></div>'
+
+# Without this, the <html> and <body> boxes of all variants after the first
+# are continuations, and lose their top margin, border and padding
+# (and the previous ones their bottom ones); each page is then laid out
+# as if the variant was alone
+CLONE_DECORATIONS = '<style>html, body { box-decoration-break: clone; }</style>'
+
+
+def get_page_body(boxes):
+    for box in boxes:
+        if box.element_tag == 'body':
+            return box
+        return get_page_body(box.all_children())
+
+
+class PageFragment:
+    """
+    A header or footer template to be stamped on every page of the main document.
+
+    When the template doesn't reference any page variable (see PAGE_VARIABLES),
+    it is rendered and laid out once, and the same box tree is reused for
+    all pages.
+
+    Otherwise, the template is rendered with Django for each page (which is cheap),
+    but the resulting markup is laid out by WeasyPrint only once for each
+    distinct variant; moreover, all variants (for example: "Page 1 / 300",
+    "Page 2 / 300", ...) are laid out together in a single WeasyPrint pass,
+    one variant per page, instead of running a full layout for every page.
+
+    Usage:
+
+        fragment = PageFragment(template, render)
+        fragment.prepare(context, page_total)
+        for i, page in enumerate(doc.pages):
+            page_body.children += fragment.get_children(i + 1)
+
+    where "render" is a callable which receives the HTML content and returns
+    the WeasyPrint document.
+    """
+
+    def __init__(self, template, render):
+        self.template = template
+        self.render = render
+        self.page_invariant = is_page_invariant(template)
+        self.markups = []
+        self.bodies = {}
+        self.page_offset = 0
+
+    def prepare(self, context, page_total, page_offset=0, page_count=None):
+        """
+        Render the template for each page (or just once, when page invariant),
+        then lay out all distinct variants.
+
+        When laying out a part of a longer document, only "page_count" pages
+        are prepared, starting after "page_offset"
+        """
+        if page_count is None:
+            page_count = page_total - page_offset
+        self.page_offset = page_offset
+        if self.page_invariant:
+            self.markups = [self.template.render(context), ] * page_count
+        else:
+            self.markups = []
+            for i in range(page_count):
+                context['page_counter'] = page_offset + i + 1
+                self.markups.append(self.template.render(context))
+        variants = list(dict.fromkeys(self.markups))
+        self.bodies = dict(zip(variants, self.layout(variants)))
+        _count(hits=page_count - len(variants), misses=len(variants))
+        profile_count('fragment_layouts', len(variants))
+        profile_count('fragment_reuses', page_count - len(variants))
+        return self
+
+    def get_children(self, page_counter):
+        """
+        Return the boxes to be appended to the body of the given page (1-based)
+        """
+        body = self.bodies[self.markups[page_counter - self.page_offset - 1]]
+        return body.all_children()
+
+    def layout(self, variants):
+        """
+        Lay out the given markups, and return the corresponding <body> boxes
+        """
+        if len(variants) > 1:
+            bodies = self.layout_together(variants)
+            if bodies is not None:
+                return bodies
+        return [self.layout_one(markup) for markup in variants]
+
+    def layout_one(self, markup):
+        doc = self.render(markup)
+        return self.extract_body(doc.pages[0])
+
+    def layout_together(self, variants):
+        """
+        Join all variants in a single document (one per page) and lay it out once;
+        returns None when this is not possible, and each variant should be
+        laid out separately
+        """
+        matches = [BODY_RE.search(markup) for markup in variants]
+        if not all(matches):
+            return None
+
+        # Keep <head> and <body> from the first variant, and concatenate the
+        # contents of all bodies
+        first = matches[0]
+        content = PAGE_BREAK.join([match.group(2) for match in matches])
+        markup = (
+            variants[0][:first.start(1)] + CLONE_DECORATIONS +
+            variants[0][first.start(1):first.start(2)] + content + variants[0][first.end(2):]
+        )
+
+        doc = self.render(markup)
+        if len(doc.pages) != len(variants):
+            # Some variant didn't fit in a single page
+            return None
+        return [self.extract_body(page) for page in doc.pages]
+
+    @staticmethod
+    def extract_body(page):
+        body = get_page_body(page._page_box.all_children())
+        return body.copy_with_children(body.all_children())
@@ -0,0 +1,144 @@
+import os
+import hashlib
+import tempfile
+import threading
+from django.conf import settings
+from .cache import LRUCache
+from .profiling import profile_count
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Print-resolution images
+#
+# Images uploaded by users (for example, 24 megapixel photos printed 4 cm wide)
+# make the layout slow and the PDF documents huge; when enabled, images served
+# from "media://" and "file:///media/" which are larger than needed are
+# downscaled to the maximum print size at the maximum print resolution, and
+# recompressed.
+#
+# Derived images are saved in a cache folder, named after a hash of source
+# path, modification time, size and parameters, so they are decoded and resized
+# only once; the mapping from source to derived image is also kept in memory.
+#
+# Requires PIL.
+#
+# Settings:
+#
+#   PDF_IMAGE_MAX_DPI -- maximum print resolution (default: None, disabled); for example: 200
+#   PDF_IMAGE_MAX_PRINT_SIZE -- maximum (width, height) of printed images, in cm
+#       (default: (19.0, 27.7), an A4 page with 1 cm margins)
+#   PDF_IMAGE_JPEG_QUALITY -- quality of recompressed JPEG images (default: 85)
+#   PDF_IMAGE_CACHE_DIR -- folder for derived images (default: "django-pdf-images" in the temp folder)
+
+IMAGE_SCHEMES = ('media://', 'file:///media/', )
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff', '.bmp', )
+
+_paths = None
+_paths_lock = threading.Lock()
+
+
+def get_image_path_cache():
+    global _paths
+    with _paths_lock:
+        if _paths is None:
+            _paths = LRUCache(max_size=1024)
+    return _paths
+
+
+def get_image_cache_dir():
+    return getattr(settings, 'PDF_IMAGE_CACHE_DIR', None) or os.path.join(tempfile.gettempdir(), 'django-pdf-images')
+
+
+def get_image_parameters():
+    """
+    Returns (max_width, max_height, jpeg_quality), with sizes in pixels,
+    or None when the image pipeline is disabled
+    """
+    max_dpi = getattr(settings, 'PDF_IMAGE_MAX_DPI', None)
+    if not max_dpi:
+        return None
+    width, height = getattr(settings, 'PDF_IMAGE_MAX_PRINT_SIZE', (19.0, 27.7))
+    return (
+        int(round(width / 2.54 * max_dpi)),
+        int(round(height / 2.54 * max_dpi)),
+        getattr(settings, 'PDF_IMAGE_JPEG_QUALITY', 85),
+    )
+
+
+def get_print_image_path(url, filepath):
+    """
+    Returns the path of the image to be embedded in the document for the given
+    url: either "filepath" itself, or a downscaled copy
+    """
+    if not url.startswith(IMAGE_SCHEMES) or not filepath.lower().endswith(IMAGE_EXTENSIONS):
+        return filepath
+    parameters = get_image_parameters()
+    if parameters is None:
+        return filepath
+
+    stat = os.stat(filepath)
+    key = (filepath, stat.st_mtime_ns, stat.st_size, parameters)
+    cache = get_image_path_cache()
+    path = cache.get(key)
+    if path is None or not os.path.isfile(path):
+        path = downscale_image(filepath, key, *parameters)
+        cache.set(key, path)
+    return path
+
+
+def downscale_image(filepath, key, max_width, max_height, jpeg_quality):
+    """
+    Save a copy of the image, downscaled to fit (max_width, max_height) and
+    recompressed, in the cache folder (unless already there), and return its path;
+    returns "filepath" when the image is small enough already
+    """
+    try:
+        from PIL import Image as PILImage
+    except ImportError:
+        return filepath
+
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    cache_dir = get_image_cache_dir()
+    for extension in ('.jpg', '.png', ):
+        path = os.path.join(cache_dir, digest + extension)
+        if os.path.isfile(path):
+            return path
+
+    with PILImage.open(filepath) as image:
+        # Only the header has been read so far
+        if image.width <= max_width and image.height <= max_height:
+            return filepath
+
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA', ) or 'transparency' in image.info
+        exif = image.info.get('exif')
+        image.draft('RGB', (max_width, max_height))
+        image.thumbnail((max_width, max_height), PILImage.LANCZOS)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        if has_alpha or image.mode == 'P':
+            path = os.path.join(cache_dir, digest + '.png')
+            options = {'format': 'PNG', 'optimize': True, }
+        else:
+            path = os.path.join(cache_dir, digest + '.jpg')
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            options = {'format': 'JPEG', 'quality': jpeg_quality, 'optimize': True, }
+            if exif:
+                # Keep the orientation
+                options['exif'] = exif
+
+        # Write to a temporary file, then rename, so that concurrent renders
+        # never see a partial image
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, **options)
+            os.replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    profile_count('images_downscaled')
+    return path
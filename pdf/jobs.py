@@ -0,0 +1,261 @@
+import os
+import uuid
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .signals import pdf_job_finished
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Background rendering of PdfView documents
+#
+# Sample usage:
+#
+#     from pdf.jobs import submit_pdf_job, get_pdf_job
+#
+#     job_id = submit_pdf_job('reports.views.ReportDailyView', exclude_inactives=True)
+#     ...
+#     job = get_pdf_job(job_id)
+#     if job.status == PdfJob.DONE:
+#         url = job.storage.url(job.filename)
+#
+# Settings:
+#
+#   PDF_JOB_BACKEND -- dotted path of the backend class (default: 'pdf.jobs.LocalJobBackend')
+#   PDF_JOB_EXECUTOR -- 'thread' or 'process' (default: 'thread'), for LocalJobBackend
+#   PDF_JOB_WORKERS -- number of workers (default: 2), for LocalJobBackend
+#   PDF_JOB_HISTORY -- number of completed jobs remembered (default: 1000), for LocalJobBackend
+#   PDF_JOB_STORAGE -- dotted path of the storage class for the results (default: default_storage)
+#   PDF_JOB_UPLOAD_TO -- folder for the results, in the storage (default: 'pdf_jobs')
+
+
+class PdfJob:
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, view, kwargs=None, callback=None):
+        self.id = uuid.uuid4().hex
+        self.view = view if isinstance(view, str) else view.__module__ + '.' + view.__qualname__
+        self.kwargs = kwargs or {}
+        self.callback = callback
+        self.status = PdfJob.QUEUED
+        self.filename = None
+        self.error = None
+        self.traceback = None
+        self.future = None
+        self.created = timezone.now()
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return '<PdfJob %s %s [%s]>' % (self.id, self.view, self.status)
+
+    def __getstate__(self):
+        # callbacks and futures live in the submitting process only
+        state = self.__dict__.copy()
+        state['callback'] = None
+        state['future'] = None
+        return state
+
+    @property
+    def storage(self):
+        return get_job_storage()
+
+    @property
+    def is_finished(self):
+        return self.status in (PdfJob.DONE, PdfJob.FAILED, )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'view': self.view,
+            'status': self.status,
+            'filename': self.filename,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+def get_job_storage():
+    storage_class = getattr(settings, 'PDF_JOB_STORAGE', None)
+    if storage_class:
+        return import_string(storage_class)()
+    return default_storage
+
+
+def run_pdf_job(job):
+    """
+    Render the PDF document for the given job, and save it in the job storage;
+    returns the job with the updated status
+    """
+    from django.db import connections
+
+    job.started = timezone.now()
+    job.status = PdfJob.RUNNING
+    try:
+        view_class = import_string(job.view)
+        view = view_class()
+        context = view.get_context_data(**job.kwargs)
+        filename = view.build_filename(extension="pdf")
+        with tempfile.TemporaryFile() as f:
+            view.render_as_pdf_to_stream('', context, f)
+            f.seek(0)
+            name = os.path.join(getattr(settings, 'PDF_JOB_UPLOAD_TO', 'pdf_jobs'), filename)
+            job.filename = get_job_storage().save(name, File(f, name=filename))
+        job.status = PdfJob.DONE
+    except Exception as e:
+        job.status = PdfJob.FAILED
+        job.error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        job.traceback = traceback.format_exc()
+    finally:
+        job.finished = timezone.now()
+        # Connections opened by this worker are not reused by Django
+        connections.close_all()
+    return job
+
+
+def init_pdf_worker():
+    """
+    Initializer for worker processes
+    """
+    import django
+    from django.apps import apps
+    from django.db import connections
+
+    if not apps.ready:
+        django.setup()
+    # Never share the parent's database connections (when forked):
+    # drop them without closing, since closing would affect the parent
+    for connection in connections.all():
+        connection.connection = None
+
+
+################################################################################
+# Backends
+
+class BaseJobBackend:
+    """
+    Interface for the job backends
+    """
+
+    def submit(self, job):
+        """
+        Schedule the job for rendering; when completed, the backend should call
+        self.job_finished(job)
+        """
+        raise NotImplementedError()
+
+    def get(self, job_id):
+        """
+        Return the job with given id, or None
+        """
+        raise NotImplementedError()
+
+    def job_finished(self, job):
+        if job.callback is not None:
+            try:
+                job.callback(job)
+            except Exception:
+                traceback.print_exc()
+        pdf_job_finished.send(sender=self.__class__, job=job)
+
+
+class LocalJobBackend(BaseJobBackend):
+    """
+    Render the documents in a local thread (or process) pool;
+    job status is kept in memory, in the submitting process
+    """
+
+    def __init__(self, executor=None, workers=None, history=None):
+        executor = executor or getattr(settings, 'PDF_JOB_EXECUTOR', 'thread')
+        workers = workers or getattr(settings, 'PDF_JOB_WORKERS', 2)
+        self.history = history or getattr(settings, 'PDF_JOB_HISTORY', 1000)
+        if executor == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_pdf_worker)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pdf-job')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+        future = self.executor.submit(run_pdf_job, job)
+        future.add_done_callback(lambda future: self._done(job, future))
+        job.future = future
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None and job.status == PdfJob.QUEUED and job.future is not None and job.future.running():
+            job.status = PdfJob.RUNNING
+        return job
+
+    def _done(self, job, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            # The worker itself failed (for example: a crashed process)
+            job.status = PdfJob.FAILED
+            job.error = str(e)
+            job.finished = timezone.now()
+        else:
+            # When running in another process, we receive an updated copy
+            if result is not job:
+                for name in ('status', 'filename', 'error', 'traceback', 'started', 'finished', ):
+                    setattr(job, name, getattr(result, name))
+        self._prune()
+        self.job_finished(job)
+
+    def _prune(self):
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[job_id]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_job_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            backend_class = import_string(getattr(settings, 'PDF_JOB_BACKEND', 'pdf.jobs.LocalJobBackend'))
+            _backend = backend_class()
+    return _backend
+
+
+def submit_pdf_job(view, callback=None, **kwargs):
+    """
+    Schedule the rendering of a PdfView in the background;
+    "view" is either a PdfView subclass or its dotted path, and "kwargs"
+    are passed to view.get_context_data();
+    "callback", if supplied, is called with the job when completed.
+
+    Returns: the job id
+    """
+    job = PdfJob(view, kwargs, callback=callback)
+    get_job_backend().submit(job)
+    return job.id
+
+
+def get_pdf_job(job_id):
+    return get_job_backend().get(job_id)
@@ -0,0 +1,279 @@
+# -*- coding: UTF-8 -*-
+from __future__ import print_function
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import statistics
+import os
+import multiprocessing
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+
+CHART_TYPES = ['line', 'bar', 'horizontalBar', 'pie', 'doughnut', ]
+
+# Relative changes (in %) below this threshold are not flagged when comparing runs
+DEFAULT_TOLERANCE = 5.0
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def peak_rss_kb():
+    """
+    Peak resident set size of the current process, in KB
+    (None when the "resource" module is not available, as on Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in KB elsewhere
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def case_name(case):
+    name = 'lines=%d fragments=%s charts=%d%s' % (
+        case['lines'],
+        'on' if case['fragments'] else 'off',
+        case['charts'],
+        ' (%s)' % case['chart_format'] if case['charts'] else '',
+    )
+    if case.get('web_font'):
+        name += ' web_font'
+    if not case.get('share_font_config', True):
+        name += ' font_config=off'
+    return name
+
+
+def run_case(case):
+    """
+    Build the benchmark document case['repeat'] times; returns a dict of results.
+    Module-level, so that it can be run in a fresh process
+    """
+    with override_settings(PDF_SHARE_FONT_CONFIG=case.get('share_font_config', True)):
+        return _run_case(case)
+
+
+def _run_case(case):
+    from pdf.views import PdfBenchmarkView
+    from pdf.utils import get_css_cache
+
+    # Each case starts with fresh stylesheets and font configurations
+    get_css_cache().clear()
+
+    walls = []
+    best_profile = None
+    size = 0
+    for i in range(case['repeat']):
+        started = time.perf_counter()
+        view = PdfBenchmarkView()
+        if not case['fragments']:
+            view.header_template_name = None
+            view.footer_template_name = None
+        context = view.get_context_data(
+            lines=case['lines'],
+            charts=case['charts'],
+            chart_types=case['chart_types'],
+            chart_format=case['chart_format'],
+            use_chart_cache=case['chart_cache'],
+            web_font=case.get('web_font', ''),
+        )
+        with io.BytesIO() as output:
+            profile = view.render_as_pdf_to_stream('', context, output)
+            size = len(output.getbuffer())
+        wall = time.perf_counter() - started
+        if not walls or wall < min(walls):
+            best_profile = profile
+        walls.append(wall)
+
+    wall = min(walls)
+    pages = best_profile.counters.get('pages', 0) if best_profile is not None else 0
+    return {
+        'name': case_name(case),
+        'case': case,
+        'wall': wall,
+        'wall_median': statistics.median(walls),
+        'pages': pages,
+        'pages_per_sec': pages / wall if wall else 0.0,
+        'size': size,
+        'peak_rss_kb': peak_rss_kb(),
+        'timings': dict(best_profile.timings) if best_profile is not None else {},
+    }
+
+
+def run_case_isolated(case):
+    """
+    Run the case in a fresh (spawned) process, so that peak RSS is not
+    inflated by the previous cases
+    """
+    from pdf.jobs import init_pdf_worker
+    from pdf.warmup import warm_up
+
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1, initializer=init_pdf_worker) as pool:
+        pool.apply(warm_up)
+        return pool.apply(run_case, (case, ))
+
+
+class Command(BaseCommand):
+    help = "Benchmark the PDF and chart pipelines with parameterized documents"
+    epilog = """
+Runs every combination of --lines, --fragments and --charts,
+and reports wall time (best of --repeat), pages/sec, peak RSS and output size.
+
+Sample usages:
+
+
+python manage.py benchmark_pdf
+
+
+python manage.py benchmark_pdf --lines 40,4000,40000 --charts 0,2 --repeat 3 --output baseline.json
+
+
+python manage.py benchmark_pdf --lines 40,4000,40000 --charts 0,2 --repeat 3 --compare baseline.json --isolate
+
+
+python manage.py benchmark_pdf --lines 400 --charts 0 --repeat 3 --web_font /usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf --font_config both
+
+Body text takes about 40 lines per page, so --lines 40000 gives about 1000 pages.
+Without --isolate all cases run in the same process, and peak RSS
+is the highest so far, not the one of each case.
+
+"""
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        if self.epilog:
+            kwargs.update({
+                'epilog': self.epilog,
+            })
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        if self.epilog:
+            parser.formatter_class =  argparse.RawTextHelpFormatter
+        return parser
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int_list, default=[40, 400, 4000], help="comma separated list of body lines (default: 40,400,4000)")
+        parser.add_argument('--fragments', choices=['on', 'off', 'both', ], default='both', help="with/without header and footer (default: both)")
+        parser.add_argument('--charts', type=int_list, default=[0, 1], help="comma separated list of charts per chart type (default: 0,1)")
+        parser.add_argument('--chart_types', default=','.join(CHART_TYPES), help="comma separated list of chart types (default: all)")
+        parser.add_argument('--chart_format', choices=['png', 'svg', ], default='png')
+        parser.add_argument('--chart_cache', action='store_true', help="use the chart cache (charts are rebuilt every time, by default)")
+        parser.add_argument('--web_font', help="absolute path of a font file, loaded with @font-face for the body text")
+        parser.add_argument('--font_config', choices=['on', 'off', 'both', ], default='on', help="with/without shared font configurations (default: on)")
+        parser.add_argument('--repeat', '-r', type=int, default=1, help="builds for each case (default: 1)")
+        parser.add_argument('--isolate', action='store_true', help="run each case in a fresh process")
+        parser.add_argument('--output', '-o', help="save results as JSON into this file")
+        parser.add_argument('--compare', '-c', help="compare with the results of a previous run (a JSON file)")
+        parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="changes (%%%%) to flag when comparing (default: %.0f)" % DEFAULT_TOLERANCE)
+
+    def build_cases(self, options):
+        fragments = {'on': [True], 'off': [False], 'both': [True, False]}[options['fragments']]
+        font_configs = {'on': [True], 'off': [False], 'both': [True, False]}[options['font_config']]
+        web_font = os.path.abspath(options['web_font']) if options['web_font'] else ''
+        if web_font and not os.path.isfile(web_font):
+            raise CommandError('Font file "%s" not found' % web_font)
+        chart_types = [chart_type for chart_type in options['chart_types'].split(',') if chart_type]
+        for chart_type in chart_types:
+            if chart_type not in CHART_TYPES:
+                raise CommandError('Unknown chart type "%s"' % chart_type)
+        cases = []
+        for lines, with_fragments, charts, share_font_config in itertools.product(options['lines'], fragments, options['charts'], font_configs):
+            cases.append({
+                'web_font': web_font,
+                'share_font_config': share_font_config,
+                'lines': lines,
+                'fragments': with_fragments,
+                'charts': charts,
+                'chart_types': chart_types,
+                'chart_format': options['chart_format'],
+                'chart_cache': options['chart_cache'],
+                'repeat': max(1, options['repeat']),
+            })
+        return cases
+
+    def load_previous(self, filepath):
+        with open(filepath) as f:
+            previous = json.load(f)
+        return {result['name']: result for result in previous['results']}
+
+    def format_change(self, value, previous_value, tolerance, lower_is_better=True):
+        if not previous_value or value is None:
+            return ''
+        change = 100.0 * (value - previous_value) / previous_value
+        flag = ''
+        if abs(change) >= tolerance:
+            worse = change > 0 if lower_is_better else change < 0
+            flag = ' WORSE' if worse else ' better'
+        return '%+.1f%%%s' % (change, flag)
+
+    def handle(self, *args, **options):
+        from pdf.warmup import warm_up
+
+        cases = self.build_cases(options)
+        previous = self.load_previous(options['compare']) if options['compare'] else None
+
+        if not options['isolate']:
+            # Measure steady state, not imports and font scanning
+            warm_up()
+
+        results = []
+        print('%-40s %10s %7s %10s %12s %12s' % ('case', 'wall (s)', 'pages', 'pages/s', 'size (KB)', 'peak RSS (MB)'))
+        for case in cases:
+            if options['isolate']:
+                result = run_case_isolated(case)
+            else:
+                result = run_case(case)
+            results.append(result)
+            print('%-40s %10.3f %7d %10.1f %12.1f %12s' % (
+                result['name'],
+                result['wall'],
+                result['pages'],
+                result['pages_per_sec'],
+                result['size'] / 1024.0,
+                '%.1f' % (result['peak_rss_kb'] / 1024.0) if result['peak_rss_kb'] is not None else '-',
+            ))
+            if previous is not None:
+                before = previous.get(result['name'])
+                if before is None:
+                    print('%-40s (no previous result)' % '')
+                else:
+                    print('%-40s %10s %7s %10s %12s %12s' % (
+                        '',
+                        self.format_change(result['wall'], before['wall'], options['tolerance']),
+                        '',
+                        self.format_change(result['pages_per_sec'], before['pages_per_sec'], options['tolerance'], lower_is_better=False),
+                        self.format_change(result['size'], before['size'], options['tolerance']),
+                        self.format_change(result['peak_rss_kb'], before.get('peak_rss_kb'), options['tolerance']),
+                    ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'date': timezone.now().isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'versions': self.versions(),
+                    'isolate': options['isolate'],
+                    'results': results,
+                }, f, indent=2)
+            print('Results in: "%s"' % options['output'])
+
+    def versions(self):
+        versions = {}
+        for module_name in ['django', 'weasyprint', 'matplotlib', 'numpy', ]:
+            try:
+                module = __import__(module_name)
+                versions[module_name] = getattr(module, '__version__', None)
+            except ImportError:
+                versions[module_name] = None
+        return versions
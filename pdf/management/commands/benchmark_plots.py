@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+from __future__ import print_function
+import io
+import time
+import base64
+import argparse
+from django.core.management.base import BaseCommand
+from pdf.plot import build_plot_from_data
+from pdf.plot import sample_plot_data
+
+CHART_TYPES = ['line', 'bar', 'horizontalBar', 'pie', 'doughnut', ]
+
+VARIANTS = [
+    # name, build_plot_from_data() parameters
+    ('png', dict(output_format='png')),
+    ('png (PIL re-encoded)', dict(output_format='png')),
+    ('png optimize', dict(output_format='png', png_options={'optimize': True})),
+    ('png 64 colors', dict(output_format='png', png_options={'colors': 64, 'optimize': True})),
+    ('svg', dict(output_format='svg')),
+]
+
+
+class Command(BaseCommand):
+    help = "Compare size and build time of charts, for each chart type and output variant"
+    epilog = """
+Sample usages:
+
+
+python manage.py benchmark_plots
+
+
+python manage.py benchmark_plots --repeat 10 --dpi 150 --base64
+
+"""
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        if self.epilog:
+            kwargs.update({
+                'epilog': self.epilog,
+            })
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        if self.epilog:
+            parser.formatter_class =  argparse.RawTextHelpFormatter
+        return parser
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', '-r', type=int, default=3, help="builds for each measure (default: 3)")
+        parser.add_argument('--dpi', type=int, default=300)
+        parser.add_argument('--base64', action='store_true', help="measure as_base64=True")
+
+    def build(self, chart_type, variant, params, dpi, as_base64):
+        image = build_plot_from_data(
+            sample_plot_data(chart_type),
+            chart_type=chart_type,
+            dpi=dpi,
+            as_base64=as_base64,
+            use_cache=False,
+            **params
+        )
+        if variant == 'png (PIL re-encoded)':
+            # The previous implementation: decode and re-encode with PIL
+            from PIL import Image as PILImage
+            content = base64.b64decode(image) if as_base64 else image
+            with io.BytesIO(content) as buffer, io.BytesIO() as output:
+                PILImage.open(buffer).save(output, format="PNG")
+                image = output.getvalue()
+            if as_base64:
+                image = base64.b64encode(image).decode()
+        return image
+
+    def handle(self, *args, **kwargs):
+        repeat = max(1, kwargs['repeat'])
+        print('%-15s %-22s %12s %10s' % ('chart type', 'variant', 'bytes', 'ms'))
+        for chart_type in CHART_TYPES:
+            # warm up matplotlib and fonts
+            self.build(chart_type, 'png', {}, kwargs['dpi'], kwargs['base64'])
+            for variant, params in VARIANTS:
+                started = time.perf_counter()
+                for i in range(repeat):
+                    image = self.build(chart_type, variant, params, kwargs['dpi'], kwargs['base64'])
+                elapsed = (time.perf_counter() - started) / repeat
+                print('%-15s %-22s %12d %10.1f' % (chart_type, variant, len(image), elapsed * 1000))
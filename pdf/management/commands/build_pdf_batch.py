@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from pdf.batch import BatchRenderer
+
+
+class Command(BaseCommand):
+    help = "Build many PDF documents from the same PdfView"
+    epilog = """
+Each line of the "items" file (use "-" for stdin) is a JSON object with the keyword
+arguments for view.get_context_data().
+
+Sample usages:
+
+
+python manage.py build_pdf_batch pdf.views.PdfTestView items.jsonl /tmp/batch
+
+
+seq 1 100 | sed 's/.*/{"lines": &}/' | python manage.py build_pdf_batch pdf.views.PdfTestView - /tmp/batch --pool
+
+"""
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        if self.epilog:
+            kwargs.update({
+                'epilog': self.epilog,
+            })
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        if self.epilog:
+            parser.formatter_class =  argparse.RawTextHelpFormatter
+        return parser
+
+    def add_arguments(self, parser):
+        parser.add_argument("view", help='dotted path of the PdfView')
+        parser.add_argument("items", help='JSON lines file with the context parameters ("-" for stdin)')
+        parser.add_argument("output_dir", help='output folder')
+        parser.add_argument('--pool', action='store_true', help="render the documents in parallel in the process pool")
+        parser.add_argument('--no_shared_styles', action='store_true', help="render the stylesheet for each document")
+
+    def read_items(self, filepath):
+        f = sys.stdin if filepath == '-' else open(filepath)
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def handle(self, *args, **kwargs):
+
+        def progress(result, done):
+            if result.error:
+                self.stderr.write('[%d] ERROR %s' % (result.index, result.error))
+            elif kwargs['verbosity'] > 1:
+                print('[%d] %s (%.2f s)' % (result.index, result.filename, result.elapsed))
+            elif done % 100 == 0:
+                print('%d documents ...' % done)
+
+        renderer = BatchRenderer(
+            kwargs['view'],
+            output_dir=kwargs['output_dir'],
+            shared_styles=not kwargs['no_shared_styles'],
+            use_pool=kwargs['pool'],
+            progress=progress,
+        )
+
+        started = time.perf_counter()
+        results = renderer.render(self.read_items(kwargs['items']))
+        elapsed = time.perf_counter() - started
+
+        errors = [result for result in results if result.error]
+        print('%d documents in %.1f s (%.2f documents/s); %d errors' % (
+            len(results), elapsed, len(results) / elapsed if elapsed else 0, len(errors)
+        ))
+        if errors:
+            raise CommandError('%d documents failed' % len(errors))
@@ -34,6 +34,9 @@ python manage.py build_test_pdf test.png -o --plot_type horizontalBar -p '{"labe
 python manage.py build_test_pdf test.png -o -p '{"labels": ["Total", "Custom", "Stock"], "columns": [[4, 13, 101, 78, 94, 152, 198, 337, 329, 290, 278, 295, 448, 353, 326, 512, 559, 408, 512, 440, 815, 1390, 819, 1562, 2615, 2217, 2352, 1929, 3469, 5791, 6900, 6195], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 25, 0, 0, 14, 36, 67, 8, 46, 67, 519, 585, 559, 433], [4, 13, 101, 78, 94, 152, 198, 337, 329, 290, 278, 295, 448, 353, 326, 512, 559, 408, 512, 415, 815, 1390, 805, 1526, 2548, 2209, 2306, 1862, 2950, 5206, 6341, 5762]], "colors": ["rgba(64, 113, 191, 0.2)", "rgba(191, 64, 64, 0.0)", "rgba(26, 179, 148, 0.0)"], "x": ["03/01/2018", "04/01/2018", "05/01/2018", "06/01/2018", "07/01/2018", "08/01/2018", "09/01/2018", "10/01/2018", "11/01/2018", "12/01/2018", "01/01/2019", "02/01/2019", "03/01/2019", "04/01/2019", "05/01/2019", "06/01/2019", "07/01/2019", "08/01/2019", "09/01/2019", "10/01/2019", "11/01/2019", "12/01/2019", "01/01/2020", "02/01/2020", "03/01/2020", "04/01/2020", "05/01/2020", "06/01/2020", "07/01/2020", "08/01/2020", "09/01/2020", "10/01/2020"]}'
 
 
+python manage.py build_test_pdf test.svg -o -p '{"labels": ["sin", "cos"], "x": [0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5], "columns": [[0.0, 9.09, -7.57, -2.79, 9.89, -5.44, -5.37, 9.91, -2.88, -7.51], [20.0, -13.07, -2.91, 16.88, -19.15, 8.16, 8.48, -19.25, 16.68, -2.56]]}'
+
+
 python manage.py build_test_pdf test.png -o --plot_type pie -p '{"labels": [], "columns": [[1498, 1217, 528, 479, 363, 353]], "colors": [["rgb(255, 99, 132)", "rgb(255, 159, 64)", "rgb(255, 205, 86)", "rgb(75, 192, 192)", "rgb(54, 162, 235)", "rgb(153, 102, 255)", "rgb(201, 203, 207)"]], "x": ["255: TOO LOW WATER LEVEL", "210: DOOR OPEN", "211: COVERS NOT AVAILABLE", "2000: Paper end", "1000: Scale not responding", "895: CAN_ABSENT_DURING_DISPENSING"]}'
 
 
@@ -52,12 +55,13 @@ python manage.py build_test_pdf test.png -o --plot_type doughnut -p '{"labels":
         return parser
 
     def add_arguments(self, parser):
-        parser.add_argument("filepath", help='ouput file path (use .pdf or .png extension as required')
+        parser.add_argument("filepath", help='ouput file path (use .pdf, .png or .svg extension as required')
         parser.add_argument('--open', '-o', action='store_true', help="open resulting file")
         parser.add_argument("--plot_data", "-p", help='JSON plot data to build a bitmap (instead of a pdf)')
         parser.add_argument('--plot_type', "-t", choices=['line', 'bar', 'horizontalBar', 'pie', 'doughnut', ], default="line")
         parser.add_argument('--plot_font', )
         parser.add_argument('--list_fonts', "-l", action='store_true', help="list matplotlib fonts and exit")
+        parser.add_argument('--pool', action='store_true', help="render the PDF document in the process pool")
 
     def list_fonts(self):
         import matplotlib
@@ -88,7 +92,7 @@ python manage.py build_test_pdf test.png -o --plot_type doughnut -p '{"labels":
         plot_data = kwargs['plot_data']
         if plot_data is not None:
             plot_data = json.loads(plot_data)
-            expected_file_extension = '.png'
+            expected_file_extension = '.svg' if file_extension.lower() == '.svg' else '.png'
 
         # File cleanup
         assert file_extension.lower() == expected_file_extension, "Wrong extension: %s" % file_extension
@@ -103,11 +107,13 @@ python manage.py build_test_pdf test.png -o --plot_type doughnut -p '{"labels":
                     as_base64=False,
                     dpi=300,
                     ylabel='test plot',
+                    output_format=expected_file_extension[1:],
                 )
                 f.write(image)
             else:
                 # Create a View to work with
                 view = PdfTestView()
+                view.render_in_pool = kwargs['pool']
                 context = view.get_context_data()
                 view.render_as_pdf_to_stream('', context, f)
 
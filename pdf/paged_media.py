@@ -0,0 +1,84 @@
+import re
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from .fragments import BODY_RE
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Paged media mode
+#
+# Instead of laying out header and footer for each page, and patching their
+# boxes into the pages of the body, the header and footer templates are
+# rendered once, inserted at the top of the body as CSS running elements,
+# and placed into the @page margin boxes by WeasyPrint itself; the page number
+# and the number of pages come from counter(page) and counter(pages), so the
+# whole document is laid out in a single pass.
+#
+# Requires WeasyPrint >= 52.
+#
+# In the header and footer templates:
+#
+#   - {{page_counter}} and {{page_total}} are rendered as placeholders
+#     (<span> elements filled by CSS counters), so they can't be used in
+#     filters or in {% if %} tags
+#   - only the contents of <body> are used; styles must be provided by the
+#     document stylesheet (see get_pdf_styles())
+#
+# Position and size of the margin boxes are defined in the "pdf/paged_media.css"
+# template, which can be overridden.
+
+MIN_WEASYPRINT_VERSION = 52
+
+PAGE_COUNTER = mark_safe('<span class="pdfPageCounter"></span>')
+PAGE_TOTAL = mark_safe('<span class="pdfPageTotal"></span>')
+
+BODY_START_RE = re.compile(r'<body[^>]*>', re.IGNORECASE)
+
+
+def check_weasyprint_version():
+    import weasyprint
+    try:
+        major = int(weasyprint.VERSION.split('.')[0])
+    except (AttributeError, ValueError):
+        return
+    if major < MIN_WEASYPRINT_VERSION:
+        raise Exception('Paged media mode requires WeasyPrint >= %d (found %s)' % (
+            MIN_WEASYPRINT_VERSION, weasyprint.VERSION))
+
+
+def get_paged_media_styles(context):
+    return render_to_string('pdf/paged_media.css', context)
+
+
+def render_running_element(template, context, css_class):
+    """
+    Render a header or footer template, with placeholders for the page variables,
+    and return the contents of its <body> wrapped in a running element
+    """
+    markup = template.render(dict(context, page_counter=PAGE_COUNTER, page_total=PAGE_TOTAL))
+    match = BODY_RE.search(markup)
+    if match:
+        markup = match.group(2)
+    return '<div class="%s">%s</div>' % (css_class, markup)
+
+
+def add_running_elements(content, header_template, footer_template, context):
+    """
+    Insert the running header and footer at the beginning of the body
+    of the main document
+    """
+    elements = ''
+    if header_template:
+        elements += render_running_element(header_template, context, 'pdfRunningHeader')
+    if footer_template:
+        elements += render_running_element(footer_template, context, 'pdfRunningFooter')
+    if not elements:
+        return content
+
+    # Running elements must precede the contents of the first page
+    match = BODY_START_RE.search(content)
+    if match is None:
+        return elements + content
+    return content[:match.end()] + elements + content[match.end():]
@@ -1,15 +1,19 @@
 import io
 import base64
+import contextlib
+import hashlib
 import json
 import math
-from PIL import Image as PILImage
+import threading
 import datetime
+from .cache import LRUCache
 
 
-def build_plot_from_data(data, chart_type='line', as_base64=False, dpi=300, ylabel=''):
+def build_plot_from_data(data, chart_type='line', as_base64=False, dpi=300, ylabel='', use_cache=True, output_format='png', png_options=None,
+                         downsample=None, max_points=None):
     """
     Build a plot from given "data";
-    Returns: a bitmap of the plot
+    Returns: a bitmap of the plot (or an SVG document, when output_format='svg')
 
     Requires:
         matplotlib
@@ -18,8 +22,22 @@ def build_plot_from_data(data, chart_type='line', as_base64=False, dpi=300, ylab
     data -- see sample_line_plot_data() for an example; if None, uses sample_line_plot_data()
     chart_type -- 'line', 'bar', 'horizontalBar', 'pie', 'line', 'doughnut',
     as_base64 -- if True, returns the base64 encoding of the bitmap
-    dpi -- bitmap resolution
+    dpi -- bitmap resolution (ignored for SVG)
     ylabel -- optional label for Y axis
+    use_cache -- if False, bypass the chart cache (see get_chart_cache_stats())
+    output_format -- 'png' (default) or 'svg'; SVG charts are embedded by WeasyPrint
+        as vectors, so they are sharp at any zoom and much smaller than a 300 dpi bitmap;
+        see chart_mime_type()
+    png_options -- optional post-processing of PNG bitmaps, to reduce their size
+        at the cost of some extra time (requires PIL); a dict with any of:
+            colors -- quantize to a palette with this number of colors (for example: 64)
+            optimize -- if True, let PIL search for the best compression
+            compress_level -- zlib compression level, 0-9
+        By default, the PNG produced by matplotlib is returned as it is.
+    downsample -- for 'line' charts only: None (plot all points), 'minmax' or 'lttb'
+        (Largest-Triangle-Three-Buckets); reduces each series to "max_points" points
+    max_points -- target number of points for each series when downsampling;
+        defaults to the chart width in pixels
 
     Data layout
     ===========
@@ -64,41 +82,214 @@ def build_plot_from_data(data, chart_type='line', as_base64=False, dpi=300, ylab
     if data == None:
         data = sample_line_plot_data()
 
+    if output_format not in CHART_MIME_TYPES:
+        raise Exception('Unknown output_format "%s"' % output_format)
+    if output_format == 'svg':
+        dpi = 72
+
+    cache_key = None
+    if use_cache:
+        cache_key = chart_cache_key(
+            data, chart_type=chart_type, dpi=dpi, ylabel=ylabel,
+            output_format=output_format, png_options=png_options,
+            downsample=downsample, max_points=max_points,
+        )
+        image_content = get_cached_chart(cache_key)
+        if image_content is not None:
+            if as_base64:
+                return base64.b64encode(image_content).decode()
+            return image_content
+
     if False:
-        image_content = build_random_image()
+        buffer = io.BytesIO(build_random_image())
     else:
-        image_content = None
+        buffer = io.BytesIO()
         try:
-            with io.BytesIO() as buffer:
-
-                colors = data['colors'] if 'colors' in data else default_plot_colors()
-                if len(colors)>0 and type(colors[0]) == list:
-                    colors = colors[0]
-
-                if chart_type == 'line':
-                    _build_line_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel)
-                elif chart_type in ['bar', 'horizontalBar', ]:
-                    _build_bar_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel, horizontal=(chart_type == 'horizontalBar'))
-                elif chart_type == 'pie':
-                    _build_pie_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel)
-                elif chart_type == 'doughnut':
-                    _build_doughnut_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel)
-                else:
-                    raise Exception('Unknown chart_type "%s"' % chart_type)
-
-                #buffer.seek(0)
-                pil_image = PILImage.open(buffer)
-                with io.BytesIO() as output:
-                    pil_image.save(output, format="PNG")
-                    image_content = output.getvalue()
+            colors = data['colors'] if 'colors' in data else default_plot_colors()
+            if len(colors)>0 and type(colors[0]) == list:
+                colors = colors[0]
+
+            if chart_type == 'line':
+                _build_line_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel, output_format=output_format,
+                                       downsample=downsample, max_points=max_points)
+            elif chart_type in ['bar', 'horizontalBar', ]:
+                _build_bar_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel, horizontal=(chart_type == 'horizontalBar'), output_format=output_format)
+            elif chart_type == 'pie':
+                _build_pie_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel, output_format=output_format)
+            elif chart_type == 'doughnut':
+                _build_doughnut_plot_image(data, colors, buffer, dpi=dpi, ylabel=ylabel, output_format=output_format)
+            else:
+                raise Exception('Unknown chart_type "%s"' % chart_type)
+
+            if png_options and output_format == 'png':
+                buffer = _post_process_png(buffer, png_options)
         except Exception as e:
             print('ERROR in build_plot_from_data(): ' + str(e))
             raise
 
-    if as_base64:
-        return base64.b64encode(image_content).decode()
+    # Use matplotlib's buffer as it is: encode to base64 straight from its memory,
+    # and copy it out only when bytes are required
+    if cache_key is not None or not as_base64:
+        image_content = buffer.getvalue()
+        if cache_key is not None:
+            set_cached_chart(cache_key, image_content)
+        if not as_base64:
+            return image_content
+
+    with buffer.getbuffer() as view:
+        return base64.b64encode(view).decode()
+
+
+def _post_process_png(buffer, png_options):
+    from PIL import Image as PILImage
+
+    buffer.seek(0)
+    pil_image = PILImage.open(buffer)
+    colors = png_options.get('colors')
+    if colors:
+        pil_image = pil_image.convert('RGBA').quantize(colors=colors)
+    save_options = {}
+    if png_options.get('optimize'):
+        save_options['optimize'] = True
+    if png_options.get('compress_level') is not None:
+        save_options['compress_level'] = png_options['compress_level']
+    output = io.BytesIO()
+    pil_image.save(output, format="PNG", **save_options)
+    return output
 
-    return image_content
+
+CHART_MIME_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+def chart_mime_type(output_format):
+    """
+    The mime type of a chart built with given output_format;
+    for example, to embed a chart built with as_base64=True:
+
+        <img src="data:{{ plot_mime_type }};base64,{{ plot_image }}">
+    """
+    return CHART_MIME_TYPES[output_format]
+
+
+################################################################################
+# Chart cache
+#
+# Charts are cached by a stable hash of their data and parameters,
+# in a process-wide LRU cache and, optionally, in a Django cache
+# (which can be shared among processes, or persisted on the filesystem)
+#
+# Settings:
+#
+#   PDF_CHART_CACHE_MAX_BYTES -- max size of the in-memory cache (default: 16 MB; 0 = disabled)
+#   PDF_CHART_CACHE -- alias of the Django cache to be used as second tier (default: None)
+#   PDF_CHART_CACHE_TIMEOUT -- timeout for the Django cache (default: 86400)
+
+_chart_cache = None
+_chart_cache_lock = threading.Lock()
+_django_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+}
+
+
+def get_chart_cache():
+    global _chart_cache
+    from django.conf import settings
+    with _chart_cache_lock:
+        if _chart_cache is None:
+            _chart_cache = LRUCache(
+                max_bytes=getattr(settings, 'PDF_CHART_CACHE_MAX_BYTES', 16 * 1024 * 1024),
+                sizeof=len,
+            )
+    return _chart_cache
+
+
+def _get_django_cache():
+    from django.conf import settings
+    alias = getattr(settings, 'PDF_CHART_CACHE', None)
+    if not alias:
+        return None
+    from django.core.cache import caches
+    return caches[alias]
+
+
+def get_chart_cache_stats():
+    """
+    Return the counters for the in-memory and Django cache tiers
+    """
+    with _chart_cache_lock:
+        django_stats = dict(_django_cache_stats)
+    return {
+        'memory': get_chart_cache().stats(),
+        'django': django_stats,
+    }
+
+
+def clear_chart_cache():
+    get_chart_cache().clear()
+
+
+def _chart_cache_key_default(value):
+    # NumPy arrays, pandas Series, ...: hash their contents, since str()
+    # would only give a summary of large arrays
+    if hasattr(value, '__array__'):
+        import numpy as np
+        array = np.asarray(value)
+        if array.dtype == object:
+            return array.tolist()
+        return {
+            'ndarray': [array.dtype.str, list(array.shape), hashlib.sha1(np.ascontiguousarray(array)).hexdigest()],
+        }
+    if hasattr(value, 'tolist'):
+        # NumPy scalars
+        return value.tolist()
+    return str(value)
+
+
+def chart_cache_key(data, **params):
+    """
+    A stable hash of the chart data and of all parameters affecting the result
+    (including the matplotlib font family)
+    """
+    try:
+        import matplotlib
+        font = matplotlib.rcParams['font.family']
+    except ImportError:
+        font = None
+    text = json.dumps(
+        {'data': data, 'params': params, 'font': font},
+        sort_keys=True,
+        separators=(',', ':'),
+        default=_chart_cache_key_default,
+    )
+    return 'pdf-chart:' + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def get_cached_chart(key):
+    cache = get_chart_cache()
+    content = cache.get(key) if cache.max_bytes else None
+    if content is None:
+        django_cache = _get_django_cache()
+        if django_cache is not None:
+            content = django_cache.get(key)
+            with _chart_cache_lock:
+                _django_cache_stats['hits' if content is not None else 'misses'] += 1
+            if content is not None and cache.max_bytes:
+                cache.set(key, content)
+    return content
+
+
+def set_cached_chart(key, content):
+    cache = get_chart_cache()
+    if cache.max_bytes:
+        cache.set(key, content)
+    django_cache = _get_django_cache()
+    if django_cache is not None:
+        from django.conf import settings
+        django_cache.set(key, content, getattr(settings, 'PDF_CHART_CACHE_TIMEOUT', 86400))
 
 
 def sample_line_plot_data():
@@ -119,9 +310,31 @@ def sample_line_plot_data():
     return data
 
 
+def sample_bar_plot_data(n=8):
+    """
+    Sample data for 'bar', 'horizontalBar', 'pie' and 'doughnut' charts
+    """
+    data = {
+        'labels': [],
+        'x': ['Item %d' % (i + 1) for i in range(n)],
+        'columns': [
+            [int(1000 / (i + 1)) for i in range(n)],
+        ],
+        'colors': [default_plot_colors(n)],
+    }
+    return data
+
+
+def sample_plot_data(chart_type):
+    if chart_type == 'line':
+        return sample_line_plot_data()
+    return sample_bar_plot_data()
+
+
 def build_random_image():
     # For test purposes only
     from random import randint
+    from PIL import Image as PILImage
     rgb = (randint(0, 255), randint(0, 255), randint(0, 255))
     image_size = (200, 200)
     image = PILImage.new('RGB', image_size, rgb)
@@ -184,49 +397,151 @@ def _plot_color(plot_colors, index):
     return color_code
 
 
-def _build_line_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel):
+@contextlib.contextmanager
+def _figure(figsize, dpi):
     """
-    Read rectangular data from given "input_filename" CSV file, and build a bitmap with the plot;
-    the result is saved in "output_filename"
+    Create a matplotlib Figure attached to an Agg canvas, without using pyplot:
+    no global state is involved, so charts can be built concurrently
+    from multiple threads; the figure is released on exit.
     """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-    # Solve "'NSWindow drag regions should only be invalidated on the Main Thread!' - macos/python"
-    # https://github.com/matplotlib/matplotlib/issues/14304#issuecomment-545717061
-    import matplotlib
-    from matplotlib import pyplot as plt
+    fig = Figure(figsize=figsize, dpi=dpi, tight_layout=True)
+    FigureCanvasAgg(fig)
+    try:
+        yield fig
+    finally:
+        fig.clear()
 
-    matplotlib.use('agg')
 
-    if 'x' in plot_data:
-        x_shared = plot_data['x']
+def _save_figure(fig, output_buffer, output_format):
+    if output_format == 'svg':
+        # Omit the creation date, so that identical charts are identical documents
+        fig.savefig(output_buffer, format='svg', metadata={'Date': None})
     else:
-        x_shared = None
+        fig.savefig(output_buffer, format=output_format)
+
 
-    formatter = matplotlib.ticker.FuncFormatter(_format_x_time)
-    fig, axes = plt.subplots(nrows=1, ncols=1, figsize=(8,3), dpi=dpi, tight_layout=True)
-    axes.xaxis.set_major_formatter(formatter)
-    for index, values in enumerate(plot_data['columns']):
+def _line_series(plot_data):
+    """
+    Yield (x, y) as NumPy arrays for each column of plot_data,
+    in either of the supported layouts
+    """
+    import numpy as np
 
+    x_shared = np.asarray(plot_data['x']) if 'x' in plot_data else None
+    for values in plot_data['columns']:
         if x_shared is not None:
             x = x_shared
-            y = values
+            y = np.asarray(values, dtype=float)
         else:
-            x = [item['x'] for item in values]
-            y = [item['y'] for item in values]
-
-        #axes.plot(x, y, color, linewidth=1)
+            n = len(values)
+            y = np.fromiter((item['y'] for item in values), dtype=float, count=n)
+            try:
+                x = np.fromiter((item['x'] for item in values), dtype=float, count=n)
+            except (TypeError, ValueError):
+                x = np.asarray([item['x'] for item in values])
         assert len(x) == len(y)
-        color = _plot_color(plot_colors, index)
-        axes.plot(x, y, color, linewidth=1)
-        # # add this column to chart
+        yield x, y
+
+
+def _minmax_indexes(y, max_points):
+    """
+    Keep the first and last point, and the min and max points of each bucket
+    """
+    import numpy as np
+
+    n = len(y)
+    buckets = max(1, max_points // 2)
+    size = int(np.ceil(n / buckets))
+    buckets = int(np.ceil(n / size))
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(buckets, size)
+    base = np.arange(buckets) * size
+    imin = base + np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    imax = base + np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    indexes = np.unique(np.concatenate(([0], imin, imax, [n - 1])))
+    return indexes[indexes < n]
+
+
+def _lttb_indexes(x, y, max_points):
+    """
+    Largest-Triangle-Three-Buckets downsampling
+    (Sveinn Steinarsson, "Downsampling Time Series for Visual Representation", 2013)
+    """
+    import numpy as np
+
+    n = len(y)
+    if not np.issubdtype(x.dtype, np.number):
+        x = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    indexes = np.empty(max_points, dtype=int)
+    indexes[0] = 0
+    indexes[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(np.nan_to_num(area, nan=-1.0)))
+        indexes[i + 1] = a
+    return indexes
+
+
+def downsample_series(x, y, max_points, method='lttb'):
+    """
+    Reduce the series (x, y) to about "max_points" points, using either
+    the 'minmax' or 'lttb' method; both preserve the visual shape of the line
+    """
+    if max_points < 3 or len(y) <= max_points:
+        return x, y
+    if method == 'minmax':
+        indexes = _minmax_indexes(y, max_points)
+    elif method == 'lttb':
+        indexes = _lttb_indexes(x, y, max_points)
+    else:
+        raise Exception('Unknown downsample method "%s"' % method)
+    return x[indexes], y[indexes]
+
+
+def _build_line_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel, output_format='png',
+                           downsample=None, max_points=None):
+    """
+    Read rectangular data from given "input_filename" CSV file, and build a bitmap with the plot;
+    the result is saved in "output_filename"
+    """
+
+    from matplotlib.ticker import FuncFormatter
 
-    plt.ylabel(ylabel)
-    if plot_data.get('labels', []):
-        plt.legend(plot_data['labels'])
-    plt.grid(axis='y', color='#ccc')
+    figsize = (8, 3)
+    if max_points is None:
+        max_points = int(figsize[0] * dpi)
 
-    #plt.grid()
-    plt.savefig(output_buffer)  # , dpi=600)
+    with _figure(figsize=figsize, dpi=dpi) as fig:
+        axes = fig.subplots(nrows=1, ncols=1)
+        axes.xaxis.set_major_formatter(FuncFormatter(_format_x_time))
+        for index, (x, y) in enumerate(_line_series(plot_data)):
+            if downsample:
+                x, y = downsample_series(x, y, max_points, method=downsample)
+            color = _plot_color(plot_colors, index)
+            axes.plot(x, y, color, linewidth=1)
+
+        axes.set_ylabel(ylabel)
+        if plot_data.get('labels', []):
+            axes.legend(plot_data['labels'])
+        axes.grid(axis='y', color='#ccc')
+
+        _save_figure(fig, output_buffer, output_format)
 
 
 def ellipsis(text, max_length):
@@ -238,17 +553,9 @@ def ellipsis(text, max_length):
     return text
 
 
-def _build_bar_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel, horizontal=False):
-    import matplotlib
-    from matplotlib import pyplot as plt
-
-    # Solve "'NSWindow drag regions should only be invalidated on the Main Thread!' - macos/python"
-    # https://github.com/matplotlib/matplotlib/issues/14304#issuecomment-545717061
-    matplotlib.use('agg')
+def _build_bar_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel, horizontal=False, output_format='png'):
 
-    fig, axes = plt.subplots(nrows=1, ncols=1, figsize=(8, 6), dpi=dpi, tight_layout=True)
-
-    values = plot_data['columns'][0]
+    values = list(plot_data['columns'][0])
     labels = [ellipsis(l, 20) for l in plot_data['x']]
     assert len(values) == len(labels)
 
@@ -260,40 +567,38 @@ def _build_bar_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel, ho
     labels.reverse()
     colors.reverse()
 
-    if horizontal:
-        axes.barh(labels, values, color=colors)
-    else:
-        axes.bar(labels, values, color=colors)
+    with _figure(figsize=(8, 6), dpi=dpi) as fig:
+        axes = fig.subplots(nrows=1, ncols=1)
 
-    plt.xticks(fontsize=10)
-    plt.yticks(fontsize=10)
+        if horizontal:
+            axes.barh(labels, values, color=colors)
+        else:
+            axes.bar(labels, values, color=colors)
 
-    #
-    # https://mode.com/example-gallery/python_horizontal_bar/
-    #
+        axes.tick_params(axis='both', labelsize=10)
 
-    # Despine
-    axes.spines['right'].set_visible(False)
-    axes.spines['top'].set_visible(False)
-    axes.spines['left'].set_visible(False)
-    axes.spines['bottom'].set_visible(False)
+        #
+        # https://mode.com/example-gallery/python_horizontal_bar/
+        #
 
-    # Draw vertical axis lines
-    vals = axes.get_xticks()
-    for tick in vals:
-        axes.axvline(x=tick, linestyle='solid', alpha=0.4, color='#eeeeee', zorder=1)
+        # Despine
+        axes.spines['right'].set_visible(False)
+        axes.spines['top'].set_visible(False)
+        axes.spines['left'].set_visible(False)
+        axes.spines['bottom'].set_visible(False)
 
-    # # Switch off ticks
-    # axes.tick_params(axis="both", which="both", bottom="off", top="off", labelbottom="on", left="off", right="off", labelleft="on")
+        # Draw vertical axis lines
+        vals = axes.get_xticks()
+        for tick in vals:
+            axes.axvline(x=tick, linestyle='solid', alpha=0.4, color='#eeeeee', zorder=1)
 
-    # # Format y-axis label
-    # axes.xaxis.set_major_formatter(matplotlib.ticker.StrMethodFormatter('{x:,g}'))
+        # # Switch off ticks
+        # axes.tick_params(axis="both", which="both", bottom="off", top="off", labelbottom="on", left="off", right="off", labelleft="on")
 
+        # # Format y-axis label
+        # axes.xaxis.set_major_formatter(matplotlib.ticker.StrMethodFormatter('{x:,g}'))
 
-    #plt.legend(plot_data['labels'], fontsize=10, )
-    #plt.ylabel(ylabel)
-    #plt.grid(axis='y', color='#ccc')
-    plt.savefig(output_buffer)  # , dpi=600)
+        _save_figure(fig, output_buffer, output_format)
 
 
 def pct_func(pct, allvals):
@@ -303,80 +608,68 @@ def pct_func(pct, allvals):
     return "{:d}\n({:.1f}%)".format(absolute, pct)
 
 
-def _build_pie_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel):
-
-    import matplotlib
-    from matplotlib import pyplot as plt
-
-    # Solve "'NSWindow drag regions should only be invalidated on the Main Thread!' - macos/python"
-    # https://github.com/matplotlib/matplotlib/issues/14304#issuecomment-545717061
-    matplotlib.use('agg')
-
-    # Adapted from:
-    # https://matplotlib.org/3.1.1/gallery/pie_and_polar_charts/pie_and_donut_labels.html
-    fig, axes = plt.subplots(nrows=1, ncols=1, figsize=(8, 6), dpi=dpi, tight_layout=True, subplot_kw=dict(aspect="equal"))
+def _build_pie_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel, output_format='png'):
 
     values = plot_data['columns'][0]
     labels = plot_data['x']
     colors = [_plot_color(plot_colors, index) for index in range(len(values))]
     assert len(values) == len(labels)
     assert len(values) == len(colors)
-    # values.reverse()
-    # labels.reverse()
-    # colors.reverse()
-
-    wedges, texts, autotexts = axes.pie(values, autopct=lambda pct: pct_func(pct, values), textprops=dict(color="w"), colors=colors, startangle=90)
-    axes.legend(wedges, labels, title="", loc="center left", bbox_to_anchor=(1, 0, 0.5, 1))
-    plt.setp(autotexts, size=8, weight="bold")
 
-    if ylabel:
-        axes.set_title(ylabel)
+    # Adapted from:
+    # https://matplotlib.org/3.1.1/gallery/pie_and_polar_charts/pie_and_donut_labels.html
+    with _figure(figsize=(8, 6), dpi=dpi) as fig:
+        axes = fig.subplots(nrows=1, ncols=1, subplot_kw=dict(aspect="equal"))
 
-    plt.savefig(output_buffer)  # , dpi=600)
+        wedges, texts, autotexts = axes.pie(values, autopct=lambda pct: pct_func(pct, values), textprops=dict(color="w"), colors=colors, startangle=90)
+        axes.legend(wedges, labels, title="", loc="center left", bbox_to_anchor=(1, 0, 0.5, 1))
+        for autotext in autotexts:
+            autotext.set_fontsize(8)
+            autotext.set_fontweight("bold")
 
+        if ylabel:
+            axes.set_title(ylabel)
 
-def _build_doughnut_plot_image (plot_data, plot_colors, output_buffer, dpi, ylabel):
+        _save_figure(fig, output_buffer, output_format)
 
-    import matplotlib
-    from matplotlib import pyplot as plt
-    import numpy as np
 
-    # Solve "'NSWindow drag regions should only be invalidated on the Main Thread!' - macos/python"
-    # https://github.com/matplotlib/matplotlib/issues/14304#issuecomment-545717061
-    matplotlib.use('agg')
+def _build_doughnut_plot_image(plot_data, plot_colors, output_buffer, dpi, ylabel, output_format='png'):
 
-    # Adapted from:
-    # https://matplotlib.org/3.1.1/gallery/pie_and_polar_charts/pie_and_donut_labels.html
-    fig, axes = plt.subplots(nrows=1, ncols=1, figsize=(8, 6), dpi=dpi, tight_layout=True, subplot_kw=dict(aspect="equal"))
+    import numpy as np
 
     values = plot_data['columns'][0]
     labels = plot_data['x']
     colors = [_plot_color(plot_colors, index) for index in range(len(values))]
     assert len(values) == len(labels)
     assert len(values) == len(colors)
-    wedges, texts, autotexts = axes.pie(
-        values,
-        autopct=lambda pct: pct_func(pct, values),
-        pctdistance=0.75,
-        #labeldistance=1.2,
-        wedgeprops=dict(width=0.5),
-        startangle=-40,
-        colors=colors
-    )
 
-    bbox_props = dict(boxstyle="square,pad=0.3", fc="w", ec="k", lw=0.72)
-    kw = dict(arrowprops=dict(arrowstyle="-"), bbox=bbox_props, zorder=0, va="center")
-
-    for i, p in enumerate(wedges):
-        ang = (p.theta2 - p.theta1)/2. + p.theta1
-        y = np.sin(np.deg2rad(ang))
-        x = np.cos(np.deg2rad(ang))
-        horizontalalignment = {-1: "right", 1: "left"}[int(np.sign(x))]
-        connectionstyle = "angle,angleA=0,angleB={}".format(ang)
-        kw["arrowprops"].update({"connectionstyle": connectionstyle})
-        #axes.annotate(recipe[i], xy=(x, y), xytext=(1.35*np.sign(x), 1.4*y), horizontalalignment=horizontalalignment, **kw)
-        axes.annotate(labels[i], xy=(x, y), xytext=(1.35*np.sign(x), 1.4*y), horizontalalignment=horizontalalignment, **kw)
-
-    if ylabel:
-        axes.set_title(ylabel)
-    plt.savefig(output_buffer)  # , dpi=600)
+    # Adapted from:
+    # https://matplotlib.org/3.1.1/gallery/pie_and_polar_charts/pie_and_donut_labels.html
+    with _figure(figsize=(8, 6), dpi=dpi) as fig:
+        axes = fig.subplots(nrows=1, ncols=1, subplot_kw=dict(aspect="equal"))
+
+        wedges, texts, autotexts = axes.pie(
+            values,
+            autopct=lambda pct: pct_func(pct, values),
+            pctdistance=0.75,
+            #labeldistance=1.2,
+            wedgeprops=dict(width=0.5),
+            startangle=-40,
+            colors=colors
+        )
+
+        bbox_props = dict(boxstyle="square,pad=0.3", fc="w", ec="k", lw=0.72)
+        kw = dict(arrowprops=dict(arrowstyle="-"), bbox=bbox_props, zorder=0, va="center")
+
+        for i, p in enumerate(wedges):
+            ang = (p.theta2 - p.theta1)/2. + p.theta1
+            y = np.sin(np.deg2rad(ang))
+            x = np.cos(np.deg2rad(ang))
+            horizontalalignment = {-1: "right", 1: "left"}[int(np.sign(x))]
+            connectionstyle = "angle,angleA=0,angleB={}".format(ang)
+            kw["arrowprops"].update({"connectionstyle": connectionstyle})
+            axes.annotate(labels[i], xy=(x, y), xytext=(1.35*np.sign(x), 1.4*y), horizontalalignment=horizontalalignment, **kw)
+
+        if ylabel:
+            axes.set_title(ylabel)
+        _save_figure(fig, output_buffer, output_format)
@@ -0,0 +1,148 @@
+import io
+import time
+import threading
+import multiprocessing
+from django.conf import settings
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# A pool of pre-warmed processes to render PDF documents on all cores
+#
+# WeasyPrint layout is CPU-bound pure-Python code, so within a single process
+# renders are serialized by the GIL; dispatching them to a pool of processes
+# lets one host render as many documents concurrently as it has cores.
+#
+# Settings:
+#
+#   PDF_POOL_SIZE -- number of processes (default: os.cpu_count())
+#   PDF_POOL_TIMEOUT -- seconds to wait for each document (default: 300)
+#   PDF_POOL_MAX_TASKS_PER_CHILD -- recycle each process after this number of documents (default: 100)
+#   PDF_POOL_WARMUP_TEMPLATES -- list of template names loaded by each process at startup
+#       (default: PDF_WARMUP_TEMPLATES, see pdf.warmup)
+#
+# The parameters of build_pdf_document() (including the context) are sent
+# to the children, so the context must be picklable.
+#
+# A child can't be interrupted while rendering, and a process stuck on a
+# document would be lost to the pool for good; so, when a document is not
+# completed within PDF_POOL_TIMEOUT, the whole pool is terminated and replaced
+# by a new one (see wait_for_result()). The other documents being rendered
+# by the old pool are then submitted again by build_pdf_document_in_pool(),
+# or fail with RenderPoolRestarted.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool_process():
+    """
+    Initializer for the pool processes: setup Django, then import WeasyPrint,
+    matplotlib and fonts, and load the templates in advance (see pdf.warmup)
+    """
+    from .jobs import init_pdf_worker
+    from .warmup import warm_up
+
+    init_pdf_worker()
+    warm_up(templates=getattr(settings, 'PDF_POOL_WARMUP_TEMPLATES', None))
+
+
+def get_render_pool():
+    """
+    Return the process-wide render pool, starting it when required
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(
+                processes=getattr(settings, 'PDF_POOL_SIZE', None),
+                initializer=init_pool_process,
+                maxtasksperchild=getattr(settings, 'PDF_POOL_MAX_TASKS_PER_CHILD', 100),
+            )
+    return _pool
+
+
+def restart_render_pool(pool):
+    """
+    Terminate "pool" (killing its processes), so that the next call to
+    get_render_pool() starts a new one; nothing is done if it has already
+    been replaced
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not pool:
+            return
+        _pool = None
+    pool.terminate()
+
+
+class RenderPoolRestarted(Exception):
+    """
+    The render pool has been restarted while a task was running
+    """
+    pass
+
+
+def wait_for_result(pool, async_result, timeout):
+    """
+    Wait for the result of a task submitted to "pool" (the render pool);
+    if not ready within "timeout" seconds, the pool is restarted (see
+    restart_render_pool()) and multiprocessing.TimeoutError is raised.
+    Raises RenderPoolRestarted if the pool is restarted in the meantime
+    (because of some other task)
+    """
+    deadline = time.monotonic() + timeout
+    while not async_result.ready():
+        if _pool is not pool:
+            raise RenderPoolRestarted('The render pool has been restarted')
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            restart_render_pool(pool)
+            raise multiprocessing.TimeoutError('Task not completed within %s seconds; the render pool has been restarted' % timeout)
+        async_result.wait(min(remaining, 1.0))
+    return async_result.get()
+
+
+def close_render_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+
+
+def _build_pdf_bytes(kwargs):
+    from .utils import build_pdf_document
+
+    with io.BytesIO() as output:
+        profile = build_pdf_document(output=output, **kwargs)
+        return output.getvalue(), profile
+
+
+def build_pdf_document_in_pool(output, timeout=None, **kwargs):
+    """
+    Same as build_pdf_document(), but the document is rendered in the render pool
+    (where the "pdf_rendered" signal and the metrics hook are invoked);
+    raises multiprocessing.TimeoutError if not completed within "timeout" seconds
+    (default: settings.PDF_POOL_TIMEOUT), after terminating and replacing the pool,
+    since the child process can't be interrupted otherwise.
+
+    If the pool is restarted because of another document, this one is
+    submitted again to the new pool, within the same "timeout"
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'PDF_POOL_TIMEOUT', 300)
+    deadline = time.monotonic() + timeout
+    while True:
+        pool = get_render_pool()
+        result = pool.apply_async(_build_pdf_bytes, (kwargs, ))
+        try:
+            content, profile = wait_for_result(pool, result, max(0, deadline - time.monotonic()))
+            break
+        except RenderPoolRestarted:
+            if time.monotonic() >= deadline:
+                raise multiprocessing.TimeoutError('Document not completed within %s seconds' % timeout)
+    output.write(content)
+    return profile
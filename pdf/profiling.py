@@ -0,0 +1,154 @@
+import time
+import threading
+import contextlib
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .signals import pdf_rendered
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Render profiling
+#
+# build_pdf_document() records the time spent in each phase, and some counters,
+# into a RenderProfile; when the document has been written, the profile is
+# sent with the "pdf_rendered" signal and passed to the metrics hook.
+#
+# Phases (in seconds; note that "css" and "assets" happen during
+# "body_layout" and "fragments", so they overlap with them):
+#
+#   styles, templates, body_template, charts, body_layout, fragments, css, assets, write
+#
+# and, for chunked documents (see pdf.chunked): page_count, merge
+#
+# Counters:
+#
+#   charts, pages, fragment_layouts, fragment_reuses, assets_fetched, images_downscaled,
+#   bytes_written, chunks
+#
+# Settings:
+#
+#   PDF_METRICS_HOOK -- dotted path of a callable(profile), invoked for each document
+
+_local = threading.local()
+
+
+class RenderProfile:
+
+    def __init__(self, title=''):
+        self.title = title
+        self.timings = OrderedDict()
+        self.counters = OrderedDict()
+
+    def __repr__(self):
+        return '<RenderProfile %s>' % self.summary()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @property
+    def total(self):
+        return sum([elapsed for name, elapsed in self.timings.items() if name not in OVERLAPPING_PHASES])
+
+    def as_dict(self):
+        return {
+            'title': self.title,
+            'total': self.total,
+            'timings': dict(self.timings),
+            'counters': dict(self.counters),
+        }
+
+    def summary(self):
+        return ', '.join(
+            ['%s: %.3f s' % (name, elapsed) for name, elapsed in self.timings.items()] +
+            ['%s: %d' % (name, value) for name, value in self.counters.items()]
+        )
+
+    def server_timing(self):
+        """
+        Value for the "Server-Timing" HTTP header (durations in milliseconds)
+        """
+        return ', '.join([
+            'pdf-%s;dur=%.1f' % (name.replace('_', '-'), elapsed * 1000)
+            for name, elapsed in self.timings.items()
+        ])
+
+    def finish(self):
+        """
+        Notify the receivers of the "pdf_rendered" signal, and the metrics hook
+        """
+        pdf_rendered.send(sender=self.__class__, profile=self)
+        hook = getattr(settings, 'PDF_METRICS_HOOK', None)
+        if hook:
+            if isinstance(hook, str):
+                hook = import_string(hook)
+            hook(self)
+
+
+OVERLAPPING_PHASES = ('css', 'assets', )
+
+
+def current_profile():
+    """
+    The profile of the document being built in the current thread, if any
+    """
+    return getattr(_local, 'profile', None)
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    """
+    Make "profile" the current profile while building a document
+    """
+    previous = current_profile()
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+
+@contextlib.contextmanager
+def profile_phase(name):
+    """
+    Record a phase in the current profile, if any
+    """
+    profile = current_profile()
+    if profile is None:
+        yield
+    else:
+        with profile.phase(name):
+            yield
+
+
+def profile_count(name, value=1):
+    profile = current_profile()
+    if profile is not None:
+        profile.count(name, value)
+
+
+class CountingWriter:
+    """
+    Wrap a writable file-like object and count the bytes written into it
+    """
+
+    def __init__(self, output, profile):
+        self.output = output
+        self.profile = profile
+
+    def write(self, data):
+        self.profile.count('bytes_written', len(data))
+        return self.output.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.output, name)
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent when a background PDF job is completed (either successfully or not);
+# arguments: job
+pdf_job_finished = Signal()
+
+# Sent when a PDF document has been built and written;
+# arguments: profile (see pdf.profiling.RenderProfile)
+pdf_rendered = Signal()
@@ -0,0 +1,132 @@
+import queue
+import threading
+from .profiling import CountingWriter
+from .fonts import release_stylesheets
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Streaming of PDF documents
+#
+# WeasyPrint writes the PDF document by pushing bytes into a file-like object;
+# here the document is written from a separate thread into a bounded queue,
+# while the caller consumes the chunks as they are produced.
+# At most (max_chunks + 1) chunks are held in memory at any time.
+
+_END = object()
+
+
+class _Error:
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class StreamCancelled(Exception):
+    pass
+
+
+class QueueWriter:
+    """
+    A write-only file-like object which splits data in chunks of "chunk_size"
+    bytes and puts them into "queue" (blocking while the queue is full)
+    """
+
+    def __init__(self, queue, chunk_size, cancelled):
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            self.put(chunk)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def put(self, item):
+        # Don't block forever if the consumer went away
+        while True:
+            if self.cancelled.is_set():
+                raise StreamCancelled()
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+
+def stream_pdf_document(doc, chunk_size=64 * 1024, max_chunks=4, profile=None):
+    """
+    Write the (already laid out) WeasyPrint document "doc" and yield the
+    resulting PDF in chunks of "chunk_size" bytes.
+
+    If a RenderProfile is supplied, the write phase is recorded into it,
+    and profile.finish() is called when the document has been written.
+
+    Sample usage:
+
+        doc = layout_pdf_document(...)
+        response = StreamingHttpResponse(stream_pdf_document(doc), content_type='application/pdf')
+    """
+    chunks = queue.Queue(maxsize=max_chunks)
+    cancelled = threading.Event()
+    writer = QueueWriter(chunks, chunk_size, cancelled)
+    documents = [doc, ]
+    del doc
+
+    def write():
+        try:
+            doc = documents.pop()
+            try:
+                if profile is None:
+                    doc.write_pdf(writer)
+                else:
+                    with profile.phase('write'):
+                        doc.write_pdf(CountingWriter(writer, profile))
+            finally:
+                # The FontConfiguration is in use until the document has been written
+                release_stylesheets(doc)
+                del doc
+            if profile is not None:
+                profile.finish()
+            writer.close()
+            writer.put(_END)
+        except StreamCancelled:
+            pass
+        except Exception as e:
+            try:
+                writer.put(_Error(e))
+            except StreamCancelled:
+                pass
+
+    thread = threading.Thread(target=write, name='pdf-stream-writer', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is _END:
+                break
+            if isinstance(item, _Error):
+                raise item.exception
+            yield item
+    finally:
+        # Either done, failed, or the consumer closed the generator:
+        # in the latter case, the writer thread will quit at its next write
+        cancelled.set()
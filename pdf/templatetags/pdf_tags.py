@@ -0,0 +1,34 @@
+from django import template
+from ..charts import CHART_REGISTRY_CONTEXT_NAME
+from ..charts import current_chart_registry
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def pdf_chart(context, data, chart_type='line', dpi=300, ylabel='', **kwargs):
+    """
+    Record a chart, and return its "charts://" url; the chart is built later,
+    together with all the other charts of the document (see pdf.charts).
+
+    Sample usage:
+
+        {% load pdf_tags %}
+        <img class="plot" src="{% pdf_chart sales chart_type='bar' ylabel='Sales' %}">
+
+    or:
+
+        {% pdf_chart sales chart_type='bar' dpi=150 as sales_chart %}
+        <img class="plot" src="{{ sales_chart }}">
+
+    Any other keyword argument of build_plot_from_data() (output_format,
+    downsample, max_points, ...) is accepted as well
+    """
+    registry = context.get(CHART_REGISTRY_CONTEXT_NAME)
+    if registry is None:
+        registry = current_chart_registry()
+    if registry is None:
+        raise Exception('{% pdf_chart %} is only available while building a PDF document')
+    return registry.defer_chart(data, chart_type=chart_type, dpi=dpi, ylabel=ylabel, **kwargs)
@@ -1,9 +1,31 @@
-import os
+import hashlib
+import threading
 from django.template.loader import get_template
 from django.template.loader import render_to_string
 from django.conf import settings
-from django.contrib.staticfiles import finders
 from django.contrib.auth import get_user_model
+from .fragments import PageFragment
+from .fragments import get_page_body
+from .cache import LRUCache
+from .fonts import new_font_config
+from .fonts import StylesheetPool
+from .fonts import StylesheetLeases
+from .fonts import current_stylesheet_leases
+from .fonts import using_stylesheet_leases
+from .fonts import release_stylesheets
+from .assets import resolve_asset_path
+from .assets import fetch_asset
+from .images import get_print_image_path
+from .charts import CHART_SCHEME
+from .charts import CHART_REGISTRY_CONTEXT_NAME
+from .charts import fetch_chart
+from .charts import get_chart_registry
+from .charts import using_chart_registry
+from .profiling import RenderProfile
+from .profiling import CountingWriter
+from .profiling import profiling
+from .profiling import profile_phase
+from .profiling import profile_count
 
 __author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
 
@@ -31,40 +53,32 @@ class Counter:
 # http://ampad.de/blog/generating-pdfs-django/
 
 def url_fetcher(url):
+    """
+    Serve local assets ("assets://", "static://", "media://" and "file:///media/")
+    from the asset cache (see pdf.assets), downscaling large media images
+    when required (see pdf.images), and charts ("charts://") from the
+    chart registry of the current document (see pdf.charts);
+    any other url is handled by WeasyPrint
+    """
 
-    import weasyprint
     original_url = url
-    url = url
+
+    if url.startswith(CHART_SCHEME):
+        return fetch_chart(url)
 
     try:
-        if url.startswith('assets://'):
-            url = url[len('assets://'):]
-            with open(os.path.join(settings.ASSETS_ROOT, url), 'rb') as asset:
-                contents = asset.read()
-            return dict(string=contents)
-        elif url.startswith('static://'):
-            url = url[len('static://'):]
-            with open(finders.find(url, all=False), 'rb') as asset:
-                contents = asset.read()
-            return dict(string=contents)
-
-        # TODO: untested ! test me !!!
-        elif url.startswith('media://'):
-            url = url[len('media://'):]
-            with open(os.path.join(settings.MEDIA_ROOT, url), 'rb') as asset:
-                contents = asset.read()
-            return dict(string=contents)
-
-        elif url.startswith('file:///media/'):
-            url = url[len('file:///media/'):]
-            with open(os.path.join(settings.MEDIA_ROOT, url), 'rb') as asset:
-                contents = asset.read()
-            return dict(string=contents)
+        filepath = resolve_asset_path(url)
+        if filepath is not None:
+            profile_count('assets_fetched')
+            with profile_phase('assets'):
+                filepath = get_print_image_path(url, filepath)
+                return fetch_asset(url, filepath)
     except Exception as e:
         trace('Error fetching "%s"' % original_url)
         trace(str(e))
         raise
 
+    import weasyprint
     return weasyprint.default_url_fetcher(url)
 
 
@@ -81,14 +95,138 @@ def get_pdf_styles(context, styles_template_name):
     return styles
 
 
+################################################################################
+# Parsed stylesheets cache
+
+_css_cache = None
+_css_cache_lock = threading.Lock()
+
+
+def get_css_cache():
+    """
+    The process-wide LRU cache of parsed stylesheets;
+    its size can be set with settings.PDF_CSS_CACHE_SIZE (default: 16; 0 = disabled)
+    """
+    global _css_cache
+    with _css_cache_lock:
+        if _css_cache is None:
+            _css_cache = LRUCache(max_size=getattr(settings, 'PDF_CSS_CACHE_SIZE', 16))
+    return _css_cache
+
+
+def get_css_cache_stats():
+    return get_css_cache().stats()
+
+
+def get_stylesheet_pool(styles):
+    """
+    Return the StylesheetPool of parsed copies (weasyprint.CSS object and
+    FontConfiguration) of the given stylesheet text; pools are kept in an LRU
+    cache, keyed by a hash of the text, and shared across documents and requests.
+    The FontConfiguration is None when settings.PDF_SHARE_FONT_CONFIG is False;
+    see pdf.fonts
+    """
+    import weasyprint
+
+    share_font_config = getattr(settings, 'PDF_SHARE_FONT_CONFIG', True)
+
+    def parse():
+        font_config = new_font_config() if share_font_config else None
+        with profile_phase('css'):
+            return weasyprint.CSS(string=styles, url_fetcher=url_fetcher, font_config=font_config), font_config
+
+    cache = get_css_cache()
+    key = hashlib.sha1(styles.encode('utf-8')).hexdigest()
+    pool = cache.get(key) if cache.max_size else None
+    if pool is None:
+        pool = StylesheetPool(
+            parse,
+            max_idle=getattr(settings, 'PDF_STYLESHEET_POOL_SIZE', 4),
+            exclusive=share_font_config,
+        )
+        if cache.max_size:
+            cache.set(key, pool)
+    return pool
+
+
+def get_stylesheet(styles):
+    """
+    Return a weasyprint.CSS object for the given stylesheet text,
+    parsing it into the cache if required (see get_stylesheet_pool())
+    """
+    pool = get_stylesheet_pool(styles)
+    item = pool.check_out()
+    pool.check_in(item)
+    return item[0]
+
+
+def render_doc(content, base_url, styles):
+    """
+    Lay out "content"; the stylesheet copy (and FontConfiguration) is the one
+    checked out by the document being laid out (see layout_pdf_document()), or,
+    outside of it, one checked out for this layout only
+    """
+    import weasyprint
+
+    leases = current_stylesheet_leases()
+    if leases is None:
+        leases = StylesheetLeases()
+        try:
+            with using_stylesheet_leases(leases):
+                return render_doc(content, base_url, styles)
+        finally:
+            leases.release()
+
+    stylesheet, font_config = leases.check_out(styles, get_stylesheet_pool)
+    doc = weasyprint.HTML(
+        string=content,
+        base_url=base_url,
+        url_fetcher=url_fetcher,
+    ).render(
+        stylesheets=[stylesheet, ],
+        font_config=font_config,
+    )
+    return doc
+
+
 ################################################################################
 # Main PDF builder
 
+def build_pdf_context(base_url, debug, title, print_date, extra_context, format='pdf'):
+    """
+    Add the common parameters to <extra_context> (which is updated in place)
+    """
+    context = extra_context or {}
+    context.update({
+        'debug': debug,
+        'format': format,
+        'title': title,
+        'print_date': print_date,
+        'base_url': base_url,
+        'MEDIA_ROOT': settings.MEDIA_ROOT,
+        'STATIC_ROOT': settings.STATIC_ROOT,
+    })
+    return context
+
+
+def load_pdf_templates(body_template_name, header_template_name, footer_template_name):
+    """
+    Load the templates used to build a PDF document;
+    returns a dict with keys 'body', 'header' and 'footer'
+    """
+    return {
+        'body': get_template(body_template_name) if body_template_name else None,
+        'header': get_template(header_template_name) if header_template_name else None,
+        'footer': get_template(footer_template_name) if footer_template_name else None,
+    }
+
+
 def build_pdf_document(
         base_url, debug, title, print_date, extra_context,
         styles_template_name, body_template_name, header_template_name, footer_template_name,
         output,
-        format='pdf'
+        format='pdf',
+        **options
     ):
     """
     Create a PDF document and save it into <ouput> buffer;
@@ -97,77 +235,156 @@ def build_pdf_document(
         1) build context with initialial parameters up to <extra_context>
         2) render templates from template names
         3) build PDF content
-        4) split PDF content into header, body and footer
-        5) rebuild PDF document paginating previous result
-    """
+        4) lay out header and footer fragments for all pages
+        5) rebuild PDF document inserting the fragments in each page
+        6) write the PDF document
+
+    Returns a RenderProfile with the time spent in each phase (see pdf.profiling);
+    you can supply your own with the "profile" option.
 
-    def render_doc(content, base_url, styles):
-        import weasyprint
-        doc = weasyprint.HTML(
-            string=content,
+    See layout_pdf_document() for the other supported "options"
+    """
+    profile = options.pop('profile', None) or RenderProfile(title)
+    with profiling(profile):
+        doc = layout_pdf_document(
             base_url=base_url,
-            url_fetcher=url_fetcher,
-        ).render(
-            stylesheets=[weasyprint.CSS(string=styles), ]
+            debug=debug,
+            title=title,
+            print_date=print_date,
+            extra_context=extra_context,
+            styles_template_name=styles_template_name,
+            body_template_name=body_template_name,
+            header_template_name=header_template_name,
+            footer_template_name=footer_template_name,
+            format=format,
+            **options
         )
-        return doc
-
-    def get_page_body(boxes):
-        for box in boxes:
-            if box.element_tag == 'body':
-                return box
-            return get_page_body(box.all_children())
-
-    def get_page_fragment(template, base_url, context):
-        if template:
-            content = template.render(context)
-            doc = render_doc(content, base_url, context['styles'])
-            body = get_page_body(doc.pages[0]._page_box.all_children())
-            body = body.copy_with_children(body.all_children())
-        else:
-            body = None
-        return body
+        try:
+            with profile.phase('write'):
+                doc.write_pdf(CountingWriter(output, profile))
+        finally:
+            release_stylesheets(doc)
+    profile.finish()
+    return profile
+
+
+def layout_pdf_document(
+        base_url, debug, title, print_date, extra_context,
+        styles_template_name, body_template_name, header_template_name, footer_template_name,
+        format='pdf',
+        templates=None,
+        styles=None,
+        paged_media=False,
+        page_offset=0,
+        page_total=None,
+    ):
+    """
+    Same as build_pdf_document(), but returns the laid out WeasyPrint document
+    instead of writing it (steps 1-5)
+
+    Options:
+        templates -- templates already loaded with load_pdf_templates(), to be reused
+        styles -- stylesheet already rendered with get_pdf_styles(), to be reused
+        paged_media -- if True, header and footer are placed in the page margins
+            as CSS running elements, and the document is laid out in a single pass
+            (see pdf.paged_media; requires WeasyPrint >= 52)
+        page_offset, page_total -- when laying out a part of a longer document
+            (see pdf.chunked): the number of pages before this part, and the number
+            of pages of the whole document
+
+    The stylesheet copies used for the layout (see pdf.fonts) stay checked out
+    until release_stylesheets(doc) is called, once the document has been written
+    """
 
     # Build context for template rendering
-    context = extra_context or {}
-    context.update({
-        'debug': debug,
-        'format': format,
-        'title': title,
-        'print_date': print_date,
-        'base_url': base_url,
-        'MEDIA_ROOT': settings.MEDIA_ROOT,
-        'STATIC_ROOT': settings.STATIC_ROOT,
-    })
+    context = build_pdf_context(base_url, debug, title, print_date, extra_context, format)
 
+    # Charts referenced as "charts://" urls are served from the registry in the context;
+    # body and fragments share the same stylesheet copies
+    leases = StylesheetLeases()
+    try:
+        with using_chart_registry(get_chart_registry(context)), using_stylesheet_leases(leases):
+            doc = _layout_pdf_document(
+                context, base_url, styles_template_name, body_template_name, header_template_name, footer_template_name,
+                templates, styles, paged_media, page_offset, page_total,
+            )
+    except:
+        leases.release()
+        raise
+    doc.stylesheet_leases = leases
+    return doc
+
+
+def _layout_pdf_document(
+        context, base_url, styles_template_name, body_template_name, header_template_name, footer_template_name,
+        templates, styles, paged_media, page_offset, page_total,
+    ):
     # Render styles and add to context
-    styles = get_pdf_styles(context, styles_template_name)
+    if styles is None:
+        with profile_phase('styles'):
+            styles = get_pdf_styles(context, styles_template_name)
     context.update({
         'styles': styles,
     })
 
     # Load templates
-    body_template = get_template(body_template_name) if body_template_name else None
-    header_template = get_template(header_template_name) if header_template_name else None
-    footer_template = get_template(footer_template_name) if footer_template_name else None
-
-    content = body_template.render(context)
-    doc = render_doc(content, base_url, context['styles'])
+    if templates is None:
+        with profile_phase('templates'):
+            templates = load_pdf_templates(body_template_name, header_template_name, footer_template_name)
+    body_template = templates['body']
+    header_template = templates['header']
+    footer_template = templates['footer']
+
+    with profile_phase('body_template'):
+        content = body_template.render(context)
+    _render_pending_charts(context)
+
+    if paged_media:
+        return _layout_paged_media_document(content, base_url, context, header_template, footer_template)
+
+    with profile_phase('body_layout'):
+        doc = render_doc(content, base_url, context['styles'])
+    profile_count('pages', len(doc.pages))
+
+    # Lay out header and footer for all pages
+    context['page_total'] = page_total or page_offset + len(doc.pages)
+    render = lambda content: render_doc(content, base_url, context['styles'])
+    with profile_phase('fragments'):
+        fragments = [
+            PageFragment(template, render).prepare(context, context['page_total'], page_offset, len(doc.pages))
+            for template in (header_template, footer_template, )
+            if template
+        ]
 
     # Navigate pages and Insert header and footer in main doc
-    context['page_total'] = len(doc.pages)
     for i, page in enumerate(doc.pages):
-
-        context['page_counter'] = i + 1
+        context['page_counter'] = page_offset + i + 1
         page_body = get_page_body(page._page_box.all_children())
-
-        header_body = get_page_fragment(header_template, base_url, context)
-        if header_body:
-            page_body.children += header_body.all_children()
-        footer_body = get_page_fragment(footer_template, base_url, context)
-        if footer_body:
-            page_body.children += footer_body.all_children()
-
-    doc.write_pdf(output)
-    return
-
+        for fragment in fragments:
+            page_body.children += fragment.get_children(page_offset + i + 1)
+
+    return doc
+
+
+def _render_pending_charts(context):
+    # Charts recorded by {% pdf_chart %} while rendering the templates
+    registry = context[CHART_REGISTRY_CONTEXT_NAME]
+    if registry.pending:
+        with profile_phase('charts'):
+            profile_count('charts', registry.render_pending())
+
+
+def _layout_paged_media_document(content, base_url, context, header_template, footer_template):
+    from .paged_media import check_weasyprint_version
+    from .paged_media import add_running_elements
+    from .paged_media import get_paged_media_styles
+
+    check_weasyprint_version()
+    with profile_phase('fragments'):
+        content = add_running_elements(content, header_template, footer_template, context)
+        styles = context['styles'] + get_paged_media_styles(context)
+    _render_pending_charts(context)
+    with profile_phase('body_layout'):
+        doc = render_doc(content, base_url, styles)
+    profile_count('pages', len(doc.pages))
+    return doc
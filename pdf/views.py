@@ -1,3 +1,5 @@
+import json
+import hashlib
 from datetime import datetime
 
 from constance import config
@@ -5,11 +7,31 @@ from django.views.generic import TemplateView
 from django.template.defaultfilters import slugify
 from django.template.loader import get_template
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
+from django.utils import translation
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
 from django.db import connection
 
 from .utils import get_pdf_styles
 from .utils import build_pdf_document
+from .utils import layout_pdf_document
+from .streaming import stream_pdf_document
+from .pool import build_pdf_document_in_pool
+from .chunked import build_chunked_pdf_document
+from .concurrency import run_render
+from .charts import ChartRegistry
+from .charts import CHART_REGISTRY_CONTEXT_NAME
+from .charts import get_chart_registry
+from .charts import using_chart_registry
+from .profiling import RenderProfile
+from .profiling import profiling
+from .utils import trace
 from .utils import Counter
 
 ################################################################################
@@ -32,12 +54,49 @@ class PdfView(TemplateView):
     format = 'pdf'
     _print_date = None
 
+    # Set stream_response = True to send the PDF document with a StreamingHttpResponse,
+    # as it is written, instead of buffering it in full
+    stream_response = False
+    stream_chunk_size = 64 * 1024
+    stream_max_chunks = 4
+
+    # Set render_in_pool = True to render the PDF document in the process pool
+    # (see pdf.pool); the context must be picklable
+    render_in_pool = False
+
+    # Set server_timing = True to add a "Server-Timing" header with the time
+    # spent in each rendering phase (always added in debug mode);
+    # the profile of the last document is available as self.profile
+    server_timing = False
+    profile = None
+
+    # Set paged_media = True to place header and footer in the page margins
+    # as CSS running elements, with page numbers from CSS counters, and lay out
+    # the whole document in a single pass (see pdf.paged_media; requires WeasyPrint >= 52)
+    paged_media = False
+
+    # Set output_cache = True to keep the rendered PDF document in a Django cache
+    # (settings.PDF_OUTPUT_CACHE, for output_cache_timeout seconds); the key is
+    # built by get_output_cache_key(), from the view kwargs, the query string,
+    # the user and get_data_version(). Responses carry "ETag" and "Last-Modified"
+    # (and "Cache-Control: private"), and conditional requests matching the
+    # cached document are answered with 304 before any rendering
+    output_cache = False
+    output_cache_timeout = None
+    _output_cache_key = None
+
     @property
     def print_date(self):
         if self._print_date is None:
             self._print_date = timezone.now()
         return self._print_date
 
+    def get(self, request, *args, **kwargs):
+        response = self.get_cached_pdf_response()
+        if response is not None:
+            return response
+        return super().get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         try:
             self.debug = bool(int(self.request.GET.get('debug')))
@@ -77,6 +136,115 @@ class PdfView(TemplateView):
             #filename = self.print_date.strftime('%Y-%m-%d_%H-%M-%S__') + slugify(self.title) + '.pdf'
             filename = self.build_filename()
             response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        if self._output_cache_key is not None and isinstance(response, HttpResponse) and response.status_code == 200:
+            content = response.content
+            etag = self.get_output_etag(content)
+            self.get_output_cache().set(self._output_cache_key, {
+                'content': content,
+                'etag': etag,
+                'print_date': self.print_date,
+            }, self.get_output_cache_timeout())
+            self.set_output_cache_headers(response, etag)
+        if self.profile is not None:
+            if self.server_timing or self.debug:
+                response['Server-Timing'] = self.profile.server_timing()
+            if self.debug:
+                trace('PDF "%s": %s' % (self.title, self.profile.summary()))
+        return response
+
+    ############################################################################
+    # Output cache
+
+    def get_data_version(self):
+        """
+        Override to return a value which changes whenever the data shown
+        in the document change (for example, the latest update timestamp
+        of the involved records); it becomes part of the output cache key
+        """
+        return ''
+
+    def get_output_cache_key(self):
+        """
+        The output cache key for the current request, or None to skip the cache;
+        by default, built from the view class, the view kwargs, the query string,
+        the active language, the user and get_data_version().
+
+        Documents are cached per user; if the document doesn't depend on the user,
+        you can override this method and leave the user out, to share them
+        """
+        user = getattr(self.request, 'user', None)
+        key = json.dumps([
+            '%s.%s' % (self.__class__.__module__, self.__class__.__qualname__),
+            self.kwargs,
+            sorted(self.request.GET.lists()),
+            translation.get_language(),
+            user.pk if user is not None and user.is_authenticated else None,
+            self.get_data_version(),
+        ], sort_keys=True, default=str)
+        return 'pdf-output:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_output_cache(self):
+        return caches[getattr(settings, 'PDF_OUTPUT_CACHE', 'default')]
+
+    def get_output_cache_timeout(self):
+        if self.output_cache_timeout is not None:
+            return self.output_cache_timeout
+        return getattr(settings, 'PDF_OUTPUT_CACHE_TIMEOUT', 3600)
+
+    def is_output_cacheable(self):
+        """
+        Only PDF documents are cached (not "?format=html", nor "?debug=1")
+        """
+        if self.request.method != 'GET' or self.request.GET.get('format') == 'html':
+            return False
+        try:
+            return not bool(int(self.request.GET.get('debug')))
+        except:
+            return True
+
+    @staticmethod
+    def get_output_etag(content):
+        return '"%s"' % hashlib.sha1(content).hexdigest()
+
+    def set_output_cache_headers(self, response, etag):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(self.print_date.timestamp())
+        # The document might depend on the user
+        patch_cache_control(response, private=True)
+        patch_vary_headers(response, ('Cookie', ))
+
+    def get_cached_pdf_response(self):
+        """
+        Called before building the context: when the document is in the cache,
+        returns either a 304 response, for a conditional request matching its
+        ETag (a hash of its contents) or Last-Modified, or a response with the
+        cached document; otherwise returns None.
+
+        On a hit, print_date is restored from the cached document, so that
+        build_filename() matches its contents
+        """
+        self._output_cache_key = None
+        if not self.output_cache or not self.is_output_cacheable():
+            return None
+        self._output_cache_key = self.get_output_cache_key()
+        if self._output_cache_key is None:
+            return None
+
+        entry = self.get_output_cache().get(self._output_cache_key)
+        if entry is None:
+            return None
+
+        self._print_date = entry['print_date']
+        response = get_conditional_response(
+            self.request,
+            etag=entry['etag'],
+            last_modified=int(self._print_date.timestamp()),
+        )
+        if response is None:
+            response = HttpResponse(entry['content'], content_type='application/pdf')
+            if self.kwargs.get('for_download', False):
+                response['Content-Disposition'] = 'attachment; filename="%s"' % self.build_filename()
+        self.set_output_cache_headers(response, entry['etag'])
         return response
 
     def build_html_response(self, context):
@@ -97,28 +265,82 @@ class PdfView(TemplateView):
         context.update({
             'styles': styles,
         })
+        registry = get_chart_registry(context)
 
         if custom_template is not None:
             templates = [custom_template, ]
         else:
             templates = [self.header_template_name, self.body_template_name, self.footer_template_name, ]
 
-        for template_name in templates:
-            template = get_template(template_name) if template_name else None
-            if template:
-                html += template.render(context)
+        with using_chart_registry(registry):
+            for template_name in templates:
+                template = get_template(template_name) if template_name else None
+                if template:
+                    html += template.render(context)
 
         # Fix unfetched assets
         html = html.replace('static://', '/static/')
         html = html.replace('media://', '/media/')
+        registry.render_pending()
+        html = registry.inline(html)
         return html
 
     def build_pdf_response(self, context):
-        response = HttpResponse(content_type='application/pdf')
         base_url = self.request.build_absolute_uri()
+        streamable = not self.render_in_pool and self._output_cache_key is None and self.get_pdf_sections(context) is None
+        if self.stream_response and streamable:
+            return self.build_pdf_streaming_response(base_url, context)
+        response = HttpResponse(content_type='application/pdf')
         self.render_as_pdf_to_stream(base_url, context, response)
         return response
 
+    def build_pdf_streaming_response(self, base_url, context):
+        """
+        Lay out the document, then stream it while it's being written;
+        layout errors are still raised here, before the response starts
+        """
+        self.profile = RenderProfile(self.title)
+        with profiling(self.profile):
+            doc = layout_pdf_document(**self.get_pdf_document_kwargs(base_url, context))
+        chunks = stream_pdf_document(
+            doc,
+            chunk_size=self.stream_chunk_size,
+            max_chunks=self.stream_max_chunks,
+            profile=self.profile,
+        )
+        del doc
+        return StreamingHttpResponse(chunks, content_type='application/pdf')
+
+    def get_pdf_document_kwargs(self, base_url, extra_context):
+        """
+        Parameters for build_pdf_document() / layout_pdf_document()
+        """
+        return dict(
+            base_url=base_url,
+            debug=self.debug,
+            title=self.title,
+            print_date=self.print_date,
+            extra_context=extra_context,
+            styles_template_name=self.styles_template_name,
+            body_template_name=self.body_template_name,
+            header_template_name=self.header_template_name,
+            footer_template_name=self.footer_template_name,
+            format=self.format,
+            paged_media=self.paged_media,
+        )
+
+    def get_pdf_sections(self, context):
+        """
+        Override to build very long documents in sections (see pdf.chunked):
+        return an iterable of dicts, each added to the context to render
+        a section of the body; for example:
+
+            return SectionPaginator(self.get_queryset(), 500, name='movements')
+
+        The default (None) builds the document in a single pass
+        """
+        return None
+
     def render_as_pdf_to_stream(self, base_url, extra_context, output):
         """
         Build the PDF document and save in into "ouput" stream.
@@ -131,20 +353,51 @@ class PdfView(TemplateView):
             with open(filepath, 'wb') as f:
                 view.render_as_pdf_to_stream('', context, f)
 
+        Returns the RenderProfile of the document (see pdf.profiling)
         """
-        build_pdf_document(
-            base_url=base_url,
-            debug=self.debug,
-            title=self.title,
-            print_date=self.print_date,
-            extra_context=extra_context,
-            styles_template_name=self.styles_template_name,
-            body_template_name=self.body_template_name,
-            header_template_name=self.header_template_name,
-            footer_template_name=self.footer_template_name,
+        sections = self.get_pdf_sections(extra_context)
+        if sections is not None:
+            self.profile = build_chunked_pdf_document(
+                sections,
+                output=output,
+                **self.get_pdf_document_kwargs(base_url, extra_context)
+            )
+            return self.profile
+
+        if self.render_in_pool:
+            builder = build_pdf_document_in_pool
+        else:
+            builder = build_pdf_document
+        self.profile = builder(
             output=output,
-            format=self.format,
+            **self.get_pdf_document_kwargs(base_url, extra_context)
         )
+        return self.profile
+
+
+################################################################################
+# Async PdfView
+
+class AsyncPdfView(PdfView):
+    """
+    A PdfView for ASGI deployments: the context is built with sync_to_async(),
+    then the document is rendered in a dedicated thread pool (or in the process
+    pool, when render_in_pool is set), without blocking the event loop.
+
+    At most settings.PDF_ASYNC_MAX_CONCURRENT_RENDERS documents are rendered
+    at the same time; further requests wait for a free slot.
+    If the client disconnects, a render not yet started is dropped.
+
+    Requires Django >= 4.1
+    """
+
+    async def get(self, request, *args, **kwargs):
+        from asgiref.sync import sync_to_async
+        response = await sync_to_async(self.get_cached_pdf_response)()
+        if response is not None:
+            return response
+        context = await sync_to_async(self.get_context_data)(**kwargs)
+        return await run_render(self.render_to_response, context)
 
 
 ################################################################################
@@ -169,15 +422,59 @@ class PdfTestView(PdfView):
     # header_template_name = None
     # footer_template_name = None
     title = "Test"
+    plot_format = 'png'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         try:
-            from .plot import build_plot_from_data
-            plot_image = build_plot_from_data(data=None, chart_type='line', as_base64=True)
+            registry = ChartRegistry()
             context.update({
-                'plot_image': plot_image,
+                CHART_REGISTRY_CONTEXT_NAME: registry,
+                'plot_url': registry.add_chart(None, chart_type='line', output_format=self.plot_format),
             })
         except:
             pass
         return context
+
+
+class PdfBenchmarkView(PdfView):
+    """
+    Parameterized document used by the "benchmark_pdf" management command;
+    get_context_data() accepts:
+
+    lines -- number of text lines in the body (about 40 lines per page)
+    charts -- number of charts for each chart type
+    chart_types -- the chart types to include
+    chart_format -- 'png' or 'svg'
+    use_chart_cache -- if False (the default), charts are rebuilt every time
+    web_font -- absolute path of a font file, used for the body text via @font-face
+    """
+
+    body_template_name = 'pdf/pages/benchmark.html'
+    styles_template_name = 'pdf/pages/benchmark.css'
+    title = "Benchmark"
+
+    def get_context_data(self, **kwargs):
+        charts = kwargs.pop('charts', 0)
+        chart_types = kwargs.pop('chart_types', ['line', 'bar', 'horizontalBar', 'pie', 'doughnut', ])
+        chart_format = kwargs.pop('chart_format', 'png')
+        use_chart_cache = kwargs.pop('use_chart_cache', False)
+        context = super().get_context_data(**kwargs)
+        context['web_font'] = kwargs.get('web_font', '')
+        registry = ChartRegistry()
+        context[CHART_REGISTRY_CONTEXT_NAME] = registry
+        context['charts'] = []
+        if charts:
+            from .plot import sample_plot_data
+            for chart_type in chart_types:
+                for i in range(charts):
+                    context['charts'].append({
+                        'chart_type': chart_type,
+                        'url': registry.add_chart(
+                            sample_plot_data(chart_type),
+                            chart_type=chart_type,
+                            output_format=chart_format,
+                            use_cache=use_chart_cache,
+                        ),
+                    })
+        return context
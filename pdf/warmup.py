@@ -0,0 +1,112 @@
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+__author__ = 'Mario Orlandi, <mailto:morlandi@brainstorm.it>'
+
+
+################################################################################
+# Warm-up
+#
+# The first PDF built by a fresh worker process pays for importing WeasyPrint
+# and matplotlib, building the matplotlib font cache, scanning fonts with
+# fontconfig, and compiling templates and stylesheets; warm_up() does all that
+# in advance.
+#
+# Either set PDF_WARMUP_ON_READY = True to run it from PdfConfig.ready(),
+# or call it from a post-fork hook; for example, in gunicorn.conf.py:
+#
+#     def post_worker_init(worker):
+#         from pdf.warmup import warm_up
+#         warm_up(verbose=True)
+#
+# Settings:
+#
+#   PDF_WARMUP_ON_READY -- run warm_up() when the app is ready (default: False)
+#   PDF_WARMUP_TEMPLATES -- templates to compile (default: the default header, body and footer)
+#   PDF_WARMUP_STYLESHEETS -- styles templates to render and parse (default: [''], the default styles only)
+
+DEFAULT_WARMUP_TEMPLATES = ['pdf/base.html', 'pdf/header.html', 'pdf/footer.html', ]
+
+
+def _warm_up_weasyprint():
+    import weasyprint  # noqa
+
+
+def _warm_up_fonts():
+    # Let fontconfig and pango load the system fonts
+    import weasyprint
+    weasyprint.HTML(string='<p>Warm-up</p>').render()
+
+
+def _warm_up_matplotlib():
+    from matplotlib import font_manager
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    # Load (or build) the font cache, then render some text
+    font_manager.fontManager
+    fig = Figure(figsize=(1, 1), dpi=72)
+    FigureCanvasAgg(fig)
+    fig.text(0.5, 0.5, 'Warm-up')
+    fig.canvas.draw()
+    fig.clear()
+
+
+def _warm_up_templates(template_names):
+    from django.template.loader import get_template
+    from .fragments import get_template_variables
+
+    for template_name in template_names:
+        template = get_template(template_name)
+        # Analysis for page fragments is cached per template
+        get_template_variables(template)
+
+
+def _warm_up_stylesheets(styles_template_names):
+    from .utils import get_pdf_styles
+    from .utils import get_stylesheet
+
+    for styles_template_name in styles_template_names:
+        get_stylesheet(get_pdf_styles({}, styles_template_name))
+
+
+def warm_up(templates=None, stylesheets=None, verbose=False):
+    """
+    Import and initialize the libraries used to build PDF documents;
+    returns an OrderedDict with the elapsed time (in seconds) for each step,
+    or None for the steps which could not be completed (for example,
+    when matplotlib is not installed)
+    """
+    from .utils import trace
+
+    if templates is None:
+        templates = getattr(settings, 'PDF_WARMUP_TEMPLATES', DEFAULT_WARMUP_TEMPLATES)
+    if stylesheets is None:
+        stylesheets = getattr(settings, 'PDF_WARMUP_STYLESHEETS', ['', ])
+
+    steps = [
+        ('weasyprint', _warm_up_weasyprint, ()),
+        ('fonts', _warm_up_fonts, ()),
+        ('matplotlib', _warm_up_matplotlib, ()),
+        ('templates', _warm_up_templates, (templates, )),
+        ('stylesheets', _warm_up_stylesheets, (stylesheets, )),
+    ]
+
+    timings = OrderedDict()
+    for name, step, args in steps:
+        started = time.perf_counter()
+        try:
+            step(*args)
+            timings[name] = time.perf_counter() - started
+        except Exception as e:
+            timings[name] = None
+            if verbose:
+                trace('PDF warm-up: %s failed (%s)' % (name, str(e)))
+
+    if verbose:
+        trace('PDF warm-up: ' + ', '.join([
+            '%s %s' % (name, '%.3f s' % elapsed if elapsed is not None else 'skipped')
+            for name, elapsed in timings.items()
+        ]))
+    return timings
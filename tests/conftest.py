@@ -0,0 +1,31 @@
+import os
+import tempfile
+import django
+from django.conf import settings
+
+
+def pytest_configure(config):
+    if settings.configured:
+        return
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='tests',
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django.contrib.staticfiles',
+            'pdf',
+        ],
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'APP_DIRS': True,
+        }],
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        },
+        DATABASES={},
+        STATIC_URL='/static/',
+        STATIC_ROOT=os.path.join(tempfile.gettempdir(), 'django-pdf-tests', 'static'),
+        MEDIA_ROOT=os.path.join(tempfile.gettempdir(), 'django-pdf-tests', 'media'),
+    )
+    django.setup()
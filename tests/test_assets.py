@@ -0,0 +1,70 @@
+import os
+from django.conf import settings
+from django.test import override_settings
+from pdf.assets import fetch_asset
+
+
+def write_media_file(name, size):
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    filepath = os.path.join(settings.MEDIA_ROOT, name)
+    with open(filepath, 'wb') as f:
+        f.write(b'\0' * size)
+    return filepath
+
+
+def test_cacheable_assets_are_shared():
+    filepath = write_media_file('shared.png', 2 * 1024 * 1024)
+    first = fetch_asset('media://shared.png', filepath)
+    second = fetch_asset('media://shared.png', filepath)
+    assert 'file_obj' not in first
+    # Served from the asset cache, without copying
+    assert second['string'] is first['string']
+    assert first['mime_type'] == 'image/png'
+    assert first['redirected_url'] == 'media://shared.png'
+
+
+def test_large_assets_are_passed_as_files():
+    filepath = write_media_file('large.pdf', 4096)
+    with override_settings(PDF_ASSET_FILE_MIN_BYTES=4096):
+        result = fetch_asset('media://large.pdf', filepath)
+    try:
+        assert 'string' not in result
+        assert len(result['file_obj'].read()) == 4096
+        assert result['mime_type'] == 'application/pdf'
+    finally:
+        result['file_obj'].close()
+
+
+def current_rss():
+    """
+    Current resident set size in bytes (Linux only), or None
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def test_huge_assets_are_not_loaded_by_url_fetcher():
+    from pdf.utils import url_fetcher
+
+    # A sparse file: no disk space used
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    filepath = os.path.join(settings.MEDIA_ROOT, 'huge.png')
+    with open(filepath, 'wb') as f:
+        f.truncate(300 * 1024 * 1024)
+    try:
+        rss_before = current_rss()
+        result = url_fetcher('media://huge.png')
+        rss_after = current_rss()
+        try:
+            # Larger than the asset cache (default settings)
+            assert 'string' not in result
+            assert result['file_obj'].name == filepath
+        finally:
+            result['file_obj'].close()
+        if rss_before is not None:
+            assert rss_after - rss_before < 16 * 1024 * 1024
+    finally:
+        os.remove(filepath)
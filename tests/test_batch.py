@@ -0,0 +1,37 @@
+import os
+import pdf.batch
+from pdf.batch import render_pdf_batch
+
+
+class StubView:
+    body_template_name = header_template_name = footer_template_name = None
+
+    def get_context_data(self, **kwargs):
+        self.kwargs = kwargs
+        return dict(kwargs)
+
+    def get_pdf_document_kwargs(self, base_url, context):
+        return {'extra_context': context}
+
+    def build_filename(self, extension):
+        return 'report_%d.%s' % (self.kwargs['number'], extension)
+
+
+def stub_build_pdf_document(output, templates, extra_context):
+    output.write(b'%PDF-partial')
+    if extra_context['number'] == 1:
+        raise Exception('Layout failed')
+    output.write(b' done')
+
+
+def test_failed_documents_leave_no_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(pdf.batch, 'load_pdf_templates', lambda *names: {})
+    monkeypatch.setattr(pdf.batch, 'build_pdf_document', stub_build_pdf_document)
+
+    results = render_pdf_batch(StubView, [{'number': i} for i in range(3)], output_dir=str(tmp_path), shared_styles=False)
+
+    assert [result.error is None for result in results] == [True, False, True]
+    assert results[1].filename is None
+    assert sorted(os.listdir(str(tmp_path))) == ['000000__report_0.pdf', '000002__report_2.pdf']
+    with open(results[2].filename, 'rb') as f:
+        assert f.read() == b'%PDF-partial done'
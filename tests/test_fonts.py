@@ -0,0 +1,41 @@
+import itertools
+from pdf.fonts import StylesheetPool
+from pdf.fonts import StylesheetLeases
+
+
+def counting_pool(**kwargs):
+    counter = itertools.count()
+    return StylesheetPool(lambda: ('css', next(counter)), **kwargs)
+
+
+def test_concurrent_documents_get_different_copies():
+    pool = counting_pool(max_idle=2)
+    first, second = StylesheetLeases(), StylesheetLeases()
+    a = first.check_out('styles', lambda styles: pool)
+    b = second.check_out('styles', lambda styles: pool)
+    assert a is not b
+    # All layouts of a document share its copy
+    assert first.check_out('styles', lambda styles: pool) is a
+    first.release()
+    second.release()
+    # Checked in copies are reused
+    assert StylesheetLeases().check_out('styles', lambda styles: pool) in (a, b)
+
+
+def test_idle_copies_are_bounded():
+    pool = counting_pool(max_idle=1)
+    leases = [StylesheetLeases() for i in range(3)]
+    for lease in leases:
+        lease.check_out('styles', lambda styles: pool)
+    for lease in leases:
+        lease.release()
+    assert len(pool.idle) == 1
+
+
+def test_copies_without_font_config_are_shared():
+    pool = counting_pool(exclusive=False)
+    first, second = StylesheetLeases(), StylesheetLeases()
+    a = first.check_out('styles', lambda styles: pool)
+    first.release()
+    assert second.check_out('styles', lambda styles: pool) is a
+    assert pool.check_out() is a
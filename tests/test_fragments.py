@@ -0,0 +1,143 @@
+from django import template
+from django.template import Engine
+from django.template import engines
+from pdf.fragments import get_template_variables
+from pdf.fragments import is_page_invariant
+from pdf.fragments import PageFragment
+from pdf.fragments import PAGE_BREAK
+from pdf.fragments import BODY_RE
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def page_label(context):
+    return 'Page %d' % context['page_counter']
+
+
+@register.simple_tag
+def upper(value):
+    return value.upper()
+
+
+TEMPLATES = {
+    'title.html': '<h1>{{ title }}</h1>',
+    'page.html': '<span>{{ page_counter }}</span>',
+}
+
+
+def get_template(source):
+    engine = Engine(
+        loaders=[('django.template.loaders.locmem.Loader', TEMPLATES), ],
+        libraries={'i18n': 'django.templatetags.i18n', 'page_tags': __name__},
+    )
+    return engine.from_string(source)
+
+
+def test_if():
+    t = get_template('{% if page_counter > 1 and not debug %}{{ title }}{% endif %}')
+    assert get_template_variables(t) == {'page_counter', 'debug', 'title'}
+    assert not is_page_invariant(t)
+
+
+def test_with():
+    t = get_template('{% with total=page_total|add:0 %}{{ total }}{% endwith %}')
+    assert 'page_total' in get_template_variables(t)
+    assert not is_page_invariant(t)
+
+
+def test_include():
+    assert get_template_variables(get_template('{% include "title.html" %}')) == {'title'}
+    assert is_page_invariant(get_template('{% include "title.html" %}'))
+    assert not is_page_invariant(get_template('{% include "page.html" %}'))
+    # The included template can't be determined
+    assert get_template_variables(get_template('{% include name %}')) is None
+
+
+def test_blocktranslate():
+    t = get_template('{% load i18n %}{% blocktranslate %}Page {{ page_counter }}{% endblocktranslate %}')
+    assert 'page_counter' in get_template_variables(t)
+    assert not is_page_invariant(t)
+
+
+def test_custom_tags():
+    # The tag reads the context directly
+    t = get_template('{% load page_tags %}{% page_label %}')
+    assert get_template_variables(t) is None
+    assert not is_page_invariant(t)
+    # Even without takes_context, custom tags are not analyzed
+    t = get_template('{% load page_tags %}{% upper title %}')
+    assert get_template_variables(t) is None
+
+
+class StubBox:
+    def __init__(self, element_tag, children):
+        self.element_tag = element_tag
+        self.children = children
+
+    def all_children(self):
+        return self.children
+
+    def copy_with_children(self, children):
+        return StubBox(self.element_tag, list(children))
+
+
+class StubPage:
+    def __init__(self, content):
+        self._page_box = StubBox('page', [StubBox('html', [StubBox('body', [content])])])
+
+
+class StubDocument:
+    def __init__(self, pages):
+        self.pages = [StubPage(content) for content in pages]
+
+
+class StubRender:
+    """
+    Lays out each body as one page per PAGE_BREAK; the "boxes" are the
+    text of each page
+    """
+
+    def __init__(self, max_pages=None):
+        self.max_pages = max_pages
+        self.markups = []
+
+    def __call__(self, markup):
+        self.markups.append(markup)
+        pages = BODY_RE.search(markup).group(2).split(PAGE_BREAK)
+        if self.max_pages is not None and len(pages) > self.max_pages:
+            pages = pages[:self.max_pages]
+        return StubDocument(pages)
+
+
+def fragment_template(source):
+    return engines['django'].from_string(
+        '<html><head></head><body style="padding-top: 1cm">' + source + '</body></html>'
+    )
+
+
+def test_page_invariant_fragment_is_laid_out_once():
+    render = StubRender()
+    fragment = PageFragment(fragment_template('{{ title }}'), render)
+    fragment.prepare({'title': 'Report'}, page_total=3)
+    assert len(render.markups) == 1
+    assert [fragment.get_children(i) for i in (1, 2, 3)] == [['Report']] * 3
+
+
+def test_page_variants_are_laid_out_together():
+    render = StubRender()
+    fragment = PageFragment(fragment_template('{{ page_counter }}/{{ page_total }}'), render)
+    fragment.prepare({'page_total': 5}, page_total=5, page_offset=2, page_count=3)
+    assert len(render.markups) == 1
+    # Continuation pages keep the decorations of <html> and <body>
+    assert 'box-decoration-break: clone' in render.markups[0]
+    assert [fragment.get_children(i) for i in (3, 4, 5)] == [['3/5'], ['4/5'], ['5/5']]
+
+
+def test_page_variants_fall_back_to_separate_layouts():
+    # Some variant doesn't fit in a single page
+    render = StubRender(max_pages=1)
+    fragment = PageFragment(fragment_template('{{ page_counter }}'), render)
+    fragment.prepare({}, page_total=2)
+    assert len(render.markups) == 3
+    assert [fragment.get_children(i) for i in (1, 2)] == [['1'], ['2']]
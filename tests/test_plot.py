@@ -0,0 +1,75 @@
+import gc
+import os
+import math
+from multiprocessing.pool import ThreadPool
+import pytest
+
+matplotlib = pytest.importorskip('matplotlib')
+
+
+def current_rss():
+    """
+    Current resident set size in bytes (Linux only), or None
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+CHART_TYPES = ['line', 'bar', 'horizontalBar', 'pie', 'doughnut', ]
+
+
+def chart_data(i, chart_type):
+    # A few wedges for pie charts, a few points per column otherwise
+    n = 6 if chart_type in ('pie', 'doughnut', ) else 50
+    columns = [
+        [round(10.0 * math.sin((i + j) / 2.0), 2) for j in range(n)],
+        [round(20.0 * math.cos((i + j) / 4.0), 2) for j in range(n)],
+    ]
+    if chart_type in ('pie', 'doughnut', ):
+        # Wedge sizes must be non negative
+        columns = [[abs(value) for value in column] for column in columns]
+    return {
+        'labels': ['a', 'b'],
+        'x': [0.5 * j for j in range(n)],
+        'columns': columns,
+    }
+
+
+def build(i):
+    from pdf.plot import build_plot_from_data
+    chart_type = CHART_TYPES[i % len(CHART_TYPES)]
+    return build_plot_from_data(chart_data(i, chart_type), chart_type=chart_type, dpi=72, use_cache=False)
+
+
+def live_figures():
+    from matplotlib.figure import Figure
+    gc.collect()
+    return len([obj for obj in gc.get_objects() if isinstance(obj, Figure)])
+
+
+def test_concurrent_charts_match_serial_charts():
+    serial = [build(i) for i in range(20)]
+    with ThreadPool(8) as pool:
+        concurrent = pool.map(build, range(20))
+    assert concurrent == serial
+
+
+def test_concurrent_charts_do_not_leak():
+    from matplotlib._pylab_helpers import Gcf
+
+    with ThreadPool(8) as pool:
+        # Warm up fonts and caches
+        pool.map(build, range(20))
+        rss_before = current_rss()
+        for images in (pool.map(build, range(start, start + 100)) for start in range(0, 200, 100)):
+            assert all(image.startswith(b'\x89PNG') for image in images)
+        rss_after = current_rss()
+
+    assert Gcf.get_all_fig_managers() == []
+    assert live_figures() == 0
+    if rss_before is not None:
+        # 200 charts would hold much more than this if figures were leaked
+        assert rss_after - rss_before < 25 * 1024 * 1024
@@ -0,0 +1,38 @@
+import time
+import multiprocessing
+import pytest
+import pdf.pool
+from pdf.pool import get_render_pool
+from pdf.pool import wait_for_result
+from pdf.pool import RenderPoolRestarted
+
+
+@pytest.fixture
+def render_pool(monkeypatch):
+    # A plain pool: the children don't need Django
+    pool = multiprocessing.Pool(1)
+    monkeypatch.setattr(pdf.pool, '_pool', pool)
+    yield pool
+    pool.terminate()
+    current = pdf.pool._pool
+    if current is not None and current is not pool:
+        current.terminate()
+
+
+def test_stuck_worker_is_replaced(render_pool, monkeypatch):
+    stuck = render_pool.apply_async(time.sleep, (60, ))
+    with pytest.raises(multiprocessing.TimeoutError):
+        wait_for_result(render_pool, stuck, 0.2)
+    assert pdf.pool._pool is None
+
+    # Later tasks don't wait for the stuck one
+    monkeypatch.setattr(pdf.pool, '_pool', multiprocessing.Pool(1))
+    pool = get_render_pool()
+    assert wait_for_result(pool, pool.apply_async(abs, (-1, )), 5) == 1
+
+
+def test_other_tasks_fail_when_the_pool_is_restarted(render_pool):
+    running = render_pool.apply_async(time.sleep, (60, ))
+    pdf.pool.restart_render_pool(render_pool)
+    with pytest.raises(RenderPoolRestarted):
+        wait_for_result(render_pool, running, 5)